@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Benchmark: batch story generation throughput
+#
+# Runs the batch generation (storybot_batch.py) against the local OpenAI stand-in (fake_openai.py) with 1 to 8 workers and reports the stories written per minute.
+# Throughput should grow with the number of workers until the rate limits of the scheduler are reached. By default, the image limit is raised (--image-rpm),
+# so the stand-in's latency is what limits the run. Pass --image-rpm 5 to see the effect of the default limit of the app. Run it from the repository root with:
+#
+#   python benchmarks/bench_batch.py --stories 16 --continuations 2
+#
+# Note: tiktoken needs to be able to load the encoding for the selected model (it is downloaded and cached on first use).
+
+import os
+import sys
+import argparse
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, ".."))
+
+from fake_openai import FakeOpenAIServer
+
+WORKERS = [1, 2, 4, 8]
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of the batch story generation for different numbers of workers, against a local stand-in for the OpenAI API.")
+    parser.add_argument("--stories", type=int, default=16, help="Stories per run")
+    parser.add_argument("--continuations", type=int, default=2, help="Story parts between the beginning and the ending")
+    parser.add_argument("--completion-latency", type=float, default=1.0, help="Delay of completion requests in seconds")
+    parser.add_argument("--image-latency", type=float, default=2.0, help="Delay of image requests in seconds")
+    parser.add_argument("--image-rpm", type=int, default=1000, help="Image requests per minute allowed by the scheduler")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(latency=0.2, completion_latency=args.completion_latency, token_latency=0.0, image_latency=args.image_latency).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url # Read by storybot.py when it is imported below
+    import storybot
+    import storybot_batch
+    storybot_batch.quietStreamlit()
+    storybot.rate_limits['image'] = (args.image_rpm, None)
+
+    themes = [f"Story {i}: a little dragon who is afraid of the dark" for i in range(args.stories)]
+    print(f"{'workers':>7} | {'stories':>7} | {'seconds':>8} | {'stories/min':>11}")
+    for workers in WORKERS:
+        with tempfile.TemporaryDirectory() as out_dir:
+            # Every run uses an API key of its own, so it starts with full rate limit buckets
+            summary = storybot_batch.runBatch(themes, out_dir, f"sk-bench-{workers}", workers=workers, continuations=args.continuations)
+        print(f"{workers:>7} | {summary['stories']:>7} | {summary['duration']:>8.1f} | {summary['stories_per_minute']:>11.1f}", flush=True)
+    server.stop()
+
+if __name__ == "__main__":
+    main()
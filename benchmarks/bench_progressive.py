@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Benchmark: time to the first picture, with and without progressive pictures
+#
+# Paints pictures through the image jobs of the app (startImageJob() in storybot.py) against the local OpenAI stand-in (fake_openai.py), once as they are painted by default
+# and once progressively (a quick preview first, see image_preview_tier), for each DALL-E model. Reports the time until the first picture is there (the preview, or the
+# full-quality picture), the time until the full-quality picture is there, and the cost per picture. The stand-in takes as long as DALL-E typically does for each tier
+# (see the options below). Pictures are painted one after the other. Run it from the repository root with:
+#
+#   python benchmarks/bench_progressive.py --pictures 3
+
+import os
+import sys
+import time
+import logging
+import argparse
+import statistics
+from concurrent.futures import wait
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, ".."))
+
+from fake_openai import FakeOpenAIServer
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to the first picture and cost per picture, with and without progressive pictures, against a local stand-in for the OpenAI API.")
+    parser.add_argument("--pictures", type=int, default=3, help="Pictures per model and mode")
+    parser.add_argument("--preview-latency", type=float, default=2.0, help="Seconds to paint a preview (dall-e-2, 256x256)")
+    parser.add_argument("--dalle2-latency", type=float, default=5.0, help="Seconds to paint a dall-e-2 picture (1024x1024)")
+    parser.add_argument("--dalle3-latency", type=float, default=12.0, help="Seconds to paint a dall-e-3 picture (1024x1024)")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(latency=0.0, image_tier_latency={("dall-e-2", "256x256"): args.preview_latency, ("dall-e-2", "1024x1024"): args.dalle2_latency,
+                                                               ("dall-e-3", "1024x1024"): args.dalle3_latency}).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url # Read by storybot.py when it is imported below
+    import streamlit as st
+    import storybot
+    for name in list(logging.root.manager.loggerDict): # Streamlit sets the level of each of its loggers individually
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+    storybot.rate_limits['image'] = (1000, None) # The stand-in's latency is what limits the run, not the scheduler
+    st.session_state.use_cache = False
+
+    print(f"{'model':>8} | {'mode':>11} | {'first picture (s)':>17} | {'full picture (s)':>16} | {'$/picture':>9}")
+    for model in storybot.dalle_model_options:
+        dalle = storybot.getClients(f"sk-bench-progressive-{model}", storybot.gpt_model_options[0])[0]
+        st.session_state.dalle_model = model
+        for progressive in (False, True):
+            st.session_state.progressive_images = progressive
+            st.session_state.image_jobs = []
+            first, full = [], []
+            for i in range(args.pictures):
+                start = time.perf_counter()
+                job = storybot.startImageJob(dalle, f"Picture {i}: a little dragon looking at the stars")
+                job['future'].result()
+                first.append(time.perf_counter() - start)
+                wait([job['upgrade'] or job['future']])
+                full.append(time.perf_counter() - start)
+            mode = "progressive" if progressive else "default"
+            print(f"{model:>8} | {mode:>11} | {statistics.median(first):>17.2f} | {statistics.median(full):>16.2f} | {storybot.getImageCost(model, progressive):>9.3f}", flush=True)
+    server.stop()
+
+if __name__ == "__main__":
+    main()
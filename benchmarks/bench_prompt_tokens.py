@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Benchmark: prompt tokens per story turn
+#
+# Compares the prompt length (in tokens) of a story turn with the chat-message prompts of the app (see promptTemplates in storybot.py) to the earlier layout, in which
+# the instructions and the chat history were interpolated into a single text prompt, the history as the string representation of a list of dicts (which, like in the
+# app back then, already held the user prompt of the turn that is also sent as 'User Input'). The chat messages are rendered by the stage-1 template of the app, as they are
+# sent. Both are counted the way the API counts chat messages (content plus message_token_overhead per message, plus reply_token_overhead). No requests are sent.
+# Run it from the repository root with:
+#
+#   python benchmarks/bench_prompt_tokens.py --turns 1 5 10 20
+#
+# Note: tiktoken needs to be able to load the encoding for the selected model (it is downloaded and cached on first use). The counts are only as good as the encoding:
+# numbers measured with any other tokenizer (e.g. an approximation used where the encodings cannot be downloaded) only show the relative saving, not the real token counts.
+
+import os
+import sys
+import json
+import random
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import storybot
+
+for name in list(logging.root.manager.loggerDict): # Streamlit sets the level of each of its loggers individually
+    if name.startswith("streamlit"):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+# The stage-1 template of the earlier layout, as it was sent (a single message, indentation included).
+LEGACY_TEMPLATE = """
+        You are a chatbot whose sole purpose is to write bedtime stories for younger children. If the user input is not related to a story, you kindly direct them to giving input for a bedtime story.
+        Your output must at all times be child-friendly, easy to understand for a young audience, and exciting to read. 
+        It should not contain difficult words and should be written in a bedtime story style.
+        Your answers should be structured in a JSON format, and include the following keys: 'story', 'dalle-prompt', 'opt1', 'opt2', 'opt3'.
+        'story' is your story fragment, which must contain a small cliffhanger at the end to allow the story to be continued. The story MUST relate to the story parts previously generated during the conversation listed under "chat history" and must not contain any plotholes.
+        'dalle-prompt' is a shorter prompt summarizing the current story part for a future dall-e prompt. 
+        The 'opt1', 'opt2', 'opt3' keys should contain keywords of 1 to 3 words, suggesting how the story could continue.
+        IF YOU FIND THAT THE USER MENTIONS TO END THE STORY IN THE CHAT HISTORY, WRITE A HAPPY END WITH NO FURTHER CLIFFHANGERS INSTEAD FOR THE 'STORY' VALUE AND MAKE SURE TO END ON "THE END". IN THIS CASE, DO NOT INCLUDE ANY 'OPT' KEYS IN YOUR ANSWER.
+
+        User Input: {userprompt}
+
+        Chat History: {chathistory}
+        """
+
+# Words to make up story fragments of typical length from (like in bench_sessions.py).
+WORDS = ("once upon a time little dragon named Pip was afraid of the dark every night he hid under his mossy blanket and counted stars through hole in cave roof "
+         "one evening strange light appeared window castle hill knight rode slowly towards stormy bunny wanted to fly lost star looking for home friend brave").split()
+
+def storyFragment(seed, words=100):
+    generator = random.Random(seed)
+    return " ".join(generator.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt tokens of a story turn with the chat-message prompts of the app and with the earlier single-text prompt layout.")
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 5, 10, 20], help="Story turns in the chat history")
+    parser.add_argument("--model", default=storybot.gpt_model_options[0], choices=storybot.gpt_model_options)
+    args = parser.parse_args()
+
+    user_prompt = "A lantern"
+    print(f"{'turns':>5} | {'earlier layout':>14} | {'chat messages':>13} | {'saved':>5} | {'saved %':>7}")
+    for turns in args.turns:
+        chat_history = []
+        for i in range(turns):
+            chat_history += [{'role': 'user', 'content': f"Turn {i}: what happens next?"}, {'role': 'assistant', 'content': storyFragment(i)}]
+        legacy_history = chat_history + [{'role': 'user', 'content': user_prompt}]
+        legacy = storybot.count_tokens(LEGACY_TEMPLATE.format(userprompt=user_prompt, chathistory=legacy_history), args.model) \
+            + storybot.message_token_overhead + storybot.reply_token_overhead
+        sent = storybot.getPromptTemplate(1).format_messages(chathistory=chat_history, userprompt=user_prompt)
+        response_format = storybot.getResponseFormat(1, args.model)
+        schema_tokens = storybot.count_tokens(json.dumps(response_format['json_schema']), args.model) if response_format and response_format['type'] == 'json_schema' else 0
+        messages = sum(storybot.count_tokens(msg.content, args.model) + storybot.message_token_overhead for msg in sent) + storybot.reply_token_overhead + schema_tokens
+        print(f"{turns:>5} | {legacy:>14} | {messages:>13} | {legacy - messages:>5} | {(legacy - messages) / legacy * 100:>6.1f}%", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Benchmark: rendering cost by story length
+#
+# Measures how long the app takes to render a story of 2 and of 50 turns (with a picture for every turn): once for a full rerun of the app, and once for a story turn,
+# which only reruns the chat window and the picture window (they are fragments, see main() in storybot.py). A turn should take the same time for both stories.
+# The app talks to the local stand-in (fake_openai.py) without any delay, so the timings are all about rendering. Run it from the repository root with:
+#
+#   python benchmarks/bench_rerender.py --turns 2 50 --runs 5
+#
+# Note: tiktoken needs to be able to load the encoding for the selected model (it is downloaded and cached on first use).
+
+import io
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+STORYBOT_PATH = os.path.join(BENCHMARK_DIR, "..", "storybot.py")
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, ".."))
+
+from PIL import Image
+from streamlit.testing.v1 import AppTest
+from fake_openai import FakeOpenAIServer
+from load_test import quietStreamlit
+
+# Words to make up story fragments of typical length from (like in bench_sessions.py).
+WORDS = ("once upon a time little dragon named Pip was afraid of the dark every night he hid under his mossy blanket and counted stars through hole in cave roof "
+         "one evening strange light appeared window castle hill knight rode slowly towards stormy bunny wanted to fly lost star looking for home friend brave").split()
+
+def storyFragment(seed, words=120):
+    generator = random.Random(seed)
+    return " ".join(generator.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+# Logs in and puts a story of the given number of turns into the session, with the same (stored) picture for every turn.
+def startStory(turns, image):
+    at = AppTest.from_file(STORYBOT_PATH, default_timeout=120)
+    at.run()
+    at.text_input[0].input(f"sk-fake-rerender-{turns}")
+    at.button[0].click().run()
+    chat_history = at.session_state.chat_history[:1] # The intro message
+    for i in range(turns):
+        chat_history += [{'role': 'user', 'content': f"Turn {i}: what happens next?"}, {'role': 'assistant', 'content': storyFragment(i)}]
+    at.session_state.chat_history = chat_history
+    at.session_state.token_ledger = False
+    at.session_state.image_urls = [{**image, 'caption': "A little dragon looking at the stars"} for _ in range(turns)]
+    at.session_state.conv_stage = 1
+    at.session_state.prompt_buttons = ["A firefly", "A lantern", "A star"]
+    at.run()
+    return at
+
+def timed(action):
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Rendering cost of full reruns and of story turns for stories of different lengths, against a local stand-in for the OpenAI API.")
+    parser.add_argument("--turns", type=int, nargs="+", default=[2, 50], help="Story lengths (turns) to measure")
+    parser.add_argument("--runs", type=int, default=5, help="Full reruns and story turns timed per story length")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(latency=0.0, completion_latency=0.0, token_latency=0.0, image_latency=0.0).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url # Read by storybot.py when it is imported below
+    import storybot
+    quietStreamlit()
+    picture = io.BytesIO()
+    Image.effect_noise((1024, 1024), 64).convert("RGB").save(picture, format="PNG") # A picture that does not compress much, like a real one
+    image = storybot.storeImage(picture.getvalue())
+
+    print(f"{'turns':>5} | {'full rerun p50 (ms)':>19} | {'story turn p50 (ms)':>19}")
+    for turns in args.turns:
+        at = startStory(turns, image)
+        reruns = [timed(at.run) for _ in range(args.runs)]
+        story_turns = [timed(lambda: at.chat_input[0].set_value("What happens next?").run()) for _ in range(args.runs)]
+        errors = [element.value for element in list(at.error) + list(at.exception)]
+        print(f"{turns:>5} | {statistics.median(reruns) * 1000:>19.1f} | {statistics.median(story_turns) * 1000:>19.1f}", flush=True)
+        for error in errors:
+            print(f"Error: {error}")
+    server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Benchmark: model routing and hedged requests
+#
+# After a warm-up, writes story openers (stage 0) and story parts (stage 1) against the local OpenAI stand-in (fake_openai.py), where the selected model is slower than the fast one and a
+# share of the completions stalls. Reports the latency percentiles of each task three ways: with every request going to the selected model, with routing (see model_routes
+# in storybot.py), and with routing plus hedging (see hedgeRequest()). Routing should cut the opener latency, hedging the tail (p95/p99) of the story parts.
+# Run it from the repository root with:
+#
+#   python benchmarks/bench_routing.py --requests 100 --stall-rate 0.03
+#
+# Note: tiktoken needs to be able to load the encoding for the selected model (it is downloaded and cached on first use).
+
+import os
+import sys
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, ".."))
+
+from fake_openai import FakeOpenAIServer
+from load_test import quietStreamlit
+
+SELECTED_MODEL = "gpt-4-turbo"
+FAST_MODEL = "gpt-3.5-turbo"
+HISTORY = [{'role': 'user', 'content': "A little dragon who is afraid of the dark"}, {'role': 'assistant', 'content': "Once upon a time, there was a little dragon named Pip..."}]
+
+def percentile(samples, share):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+# Writes the given number of story parts of a stage (a few at a time) and returns their latencies in seconds, and how often each model answered.
+def measure(storybot, client, stage, requests, hedge, concurrency):
+    def write(i):
+        start = time.perf_counter()
+        _, model = storybot.writeStoryPart(client, stage, HISTORY, f"What happens next? ({i})", 1000, hedge=hedge)
+        return time.perf_counter() - start, model
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(write, range(requests)))
+    models = {}
+    for _, model in results:
+        models[model] = models.get(model, 0) + 1
+    return [latency for latency, _ in results], models
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency of story requests with and without model routing and hedging, against a local stand-in for the OpenAI API.")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per task and mode")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests sent at the same time")
+    parser.add_argument("--selected-latency", type=float, default=1.0, help="Completion latency of the selected model in seconds")
+    parser.add_argument("--fast-latency", type=float, default=0.3, help="Completion latency of the fast model in seconds")
+    parser.add_argument("--stall-rate", type=float, default=0.03, help="Share of completions that stall")
+    parser.add_argument("--stall-latency", type=float, default=5.0, help="Extra delay of a stalled completion in seconds")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(latency=0.0, token_latency=0.0, model_latency={SELECTED_MODEL: args.selected_latency, FAST_MODEL: args.fast_latency},
+                              stall_rate=args.stall_rate, stall_latency=args.stall_latency, seed=1).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url # Read by storybot.py when it is imported below
+    import storybot
+    quietStreamlit()
+    storybot.rate_limits['completion'] = (100000, None) # The stand-in's latency is what limits the run, not the scheduler
+    storybot.max_concurrent_requests = 1000
+    routes = dict(storybot.model_routes)
+
+    print(f"{'task':>6} | {'mode':>15} | {'p50 (s)':>7} | {'p95 (s)':>7} | {'p99 (s)':>7} | answered by")
+    for mode, route_tasks, hedge in (("selected model", False, False), ("routed", True, False), ("routed + hedged", True, True)):
+        storybot.model_routes.update(routes if route_tasks else {task: 'selected' for task in routes})
+        storybot.getTelemetry.clear() # Every mode learns the latencies of the models (and so the hedging deadlines) by itself, in a warm-up that is not measured
+        client = storybot.getClients(f"sk-bench-routing-{len(mode)}", SELECTED_MODEL)[1]
+        for stage in (0, 1):
+            measure(storybot, client, stage, 2 * storybot.latency_min_samples, False, args.concurrency)
+        for task, stage in (("opener", 0), ("story", 1)):
+            latencies, models = measure(storybot, client, stage, args.requests, hedge, args.concurrency)
+            answered = ", ".join(f"{model} {count}" for model, count in sorted(models.items()))
+            print(f"{task:>6} | {mode:>15} | {statistics.median(latencies):>7.2f} | {percentile(latencies, 0.95):>7.2f} | {percentile(latencies, 0.99):>7.2f} | {answered}", flush=True)
+    server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Benchmark: memory per idle session
+#
+# Measures how much server memory 100 and 1,000 idle sessions take up, once with their stories kept in the session_state as they are while a session is active,
+# and once released to each of the session stores ('memory', 'sqlite' and 'kv', see session_store in storybot.py), as the app does at the end of every run
+# (see releaseStory()). Also measures how long resuming a story takes, which every run of a session does once.
+# Memory is measured with tracemalloc, which only sees Python objects: the page cache of SQLite and dbm (a few MiB at most) is not included.
+# Run it from the repository root with:
+#
+#   python benchmarks/bench_sessions.py --turns 20
+#
+# Note: tiktoken needs to be able to load the encoding for the selected model (it is downloaded and cached on first use).
+
+import os
+import sys
+import json
+import time
+import logging
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import streamlit as st
+import storybot
+
+for name in list(logging.root.manager.loggerDict): # Streamlit sets the level of each of its loggers individually
+    if name.startswith("streamlit"):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+SESSIONS = [100, 1000]
+STORES = ["memory", "sqlite", "kv"]
+MODEL = "gpt-4-turbo"
+
+# Words to make up story fragments of typical length from. Every fragment is different, so the stories do not compress better than real ones would.
+WORDS = ("once upon a time little dragon named Pip was afraid of the dark every night he hid under his mossy blanket and counted stars through hole in cave roof "
+         "one evening strange light appeared window castle hill knight rode slowly towards stormy bunny wanted to fly lost star looking for home friend brave").split()
+
+def storyFragment(seed, words=100):
+    generator = random.Random(seed)
+    return " ".join(generator.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+# Builds the story fields of a session with the given number of turns, the way the app keeps them in the session_state.
+def buildStory(turns):
+    st.session_state.gpt_model = MODEL
+    st.session_state.chat_history = []
+    st.session_state.token_ledger = False
+    storybot.introMessage()
+    for i in range(turns):
+        storybot.addMessage("user", f"Turn {i}: what happens next?")
+        storybot.addMessage("assistant", storyFragment(i))
+    image_dir = os.path.join(storybot.image_store_path, "0" * 64)
+    return {
+        'chat_history': st.session_state.chat_history,
+        'token_ledger': st.session_state.token_ledger,
+        'story_summary': {'text': storyFragment(-1), 'covered': 0, 'job': None},
+        'image_urls': [{'url': f"{image_dir}.png", 'thumb': f"{image_dir}_thumb.png", 'caption': "A little dragon looking at the stars"} for _ in range(turns)],
+        'prompt_buttons': ["A firefly", "A lantern", "A star"],
+        'conv_stage': 1,
+        'prompt_token_len': 3000,
+    }
+
+# Returns a copy of the story with strings of its own, like the story of a separate session would have (copy.deepcopy would share the strings).
+def copyStory(story):
+    copy = json.loads(json.dumps({key: value for key, value in story.items() if key != 'story_summary'}))
+    copy['story_summary'] = {**json.loads(json.dumps({'text': story['story_summary']['text'], 'covered': 0})), 'job': None}
+    return copy
+
+# Memory (bytes per session) of stories that are kept in the session_state.
+def measureLive(story, sessions):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    states = [copyStory(story) for _ in range(sessions)]
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del states
+    return memory / sessions
+
+# Memory (bytes per session) of stories that have been released to the given store, and the mean time (seconds) of resuming one of them.
+def measureStore(kind, story, sessions, directory):
+    storybot.session_store = kind
+    storybot.session_store_path = os.path.join(directory, f"sessions-{kind}-{sessions}")
+    storybot.getSessionStore.clear()
+    storybot.getSessionStore()
+    states = [copyStory(story) for _ in range(sessions)] # The live sessions, released one after the other below
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(sessions):
+        storybot.storePut(f"story-{i}", storybot.packStory(states[i]))
+        states[i] = None
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for i in range(0, sessions, max(1, sessions // 100)):
+        storybot.unpackStory(storybot.storeGet(f"story-{i}"))
+    resume = (time.perf_counter() - start) / len(range(0, sessions, max(1, sessions // 100)))
+    return memory / sessions, resume
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory per idle session of the storybot, with the story in the session_state and released to each session store.")
+    parser.add_argument("--turns", type=int, default=20, help="Story turns per session")
+    args = parser.parse_args()
+
+    story = buildStory(args.turns)
+    print(f"{'sessions':>8} | {'story kept in':>14} | {'KiB/session':>11} | {'resume (ms)':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        for sessions in SESSIONS:
+            print(f"{sessions:>8} | {'session_state':>14} | {measureLive(story, sessions) / 1024:>11.2f} | {'-':>11}", flush=True)
+            for kind in STORES:
+                memory, resume = measureStore(kind, story, sessions, directory)
+                print(f"{sessions:>8} | {kind + ' store':>14} | {memory / 1024:>11.2f} | {resume * 1000:>11.3f}", flush=True)
+            storybot.getSessionStore.clear()
+
+if __name__ == "__main__":
+    main()
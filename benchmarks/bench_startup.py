@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Cold start and rerun benchmark
+#
+# Measures what a parent waits for before anything happens: the first render of the login page in a fresh process (cold start), logging in and the first render
+# of the dashboard, and the time of a plain rerun of the script once a story is going. Between the login page and the login, the benchmark waits for --think-time
+# seconds, the time a parent needs to type in their API key (the app loads openai, langchain and tiktoken in the background meanwhile).
+# Every run starts a fresh Python process, so imports and one-time setup are counted the way they are in production. The app talks to the local stand-in (fake_openai.py).
+# Run it from the repository root, e.g.:
+#
+#   python benchmarks/bench_startup.py --runs 5 --reruns 20
+#   python benchmarks/bench_startup.py --json startup.json                      # Save the results ...
+#   python benchmarks/bench_startup.py --baseline startup.json --tolerance 0.2  # ... and fail if a p95 got more than 20% worse later on
+#
+# Note: tiktoken needs to be able to load the encoding for the selected model (it is downloaded and cached on first use).
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+STORYBOT_PATH = os.path.join(BENCHMARK_DIR, "..", "storybot.py")
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fake_openai import FakeOpenAIServer
+from load_test import quietStreamlit, summarize, findRegressions
+
+
+# A single run in a fresh process: renders the login page, logs in, writes one story turn and then reruns the script a number of times.
+# Returns the timings of each stage and the errors shown by the app.
+def measureRun(reruns, think_time):
+    from streamlit.testing.v1 import AppTest # Importing streamlit itself is not part of the app's cold start
+    quietStreamlit()
+    samples, errors = {}, []
+    def timed(stage, action):
+        start = time.perf_counter()
+        action()
+        samples.setdefault(stage, []).append(time.perf_counter() - start)
+
+    at = AppTest.from_file(STORYBOT_PATH, default_timeout=120)
+    timed("cold render", at.run)
+    for _ in range(reruns):
+        timed("login rerun", at.run)
+
+    time.sleep(think_time)
+    at.text_input[0].input("sk-fake-startup")
+    timed("login", at.button[0].click().run)
+    if not at.session_state.logged_in:
+        return {"samples": samples, "errors": ["login failed"]}
+    timed("cold dashboard", at.run)
+    timed("first turn", at.chat_input[0].set_value("a dragon who is afraid of the dark").run)
+    errors.extend(element.value for element in list(at.error) + list(at.exception))
+    for _ in range(reruns):
+        timed("rerun", at.run)
+    return {"samples": samples, "errors": errors}
+
+
+def runBenchmark(args):
+    server = FakeOpenAIServer(latency=0.0, completion_latency=0.0, token_latency=0.0, image_latency=0.0).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url # Inherited by the worker processes
+
+    samples, errors = {}, []
+    for _ in range(args.runs):
+        # A new process for every run (spawned, not forked), so nothing is imported or cached yet
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(measureRun, args.reruns, args.think_time).result()
+        for stage, values in result["samples"].items():
+            samples.setdefault(stage, []).extend(values)
+        errors.extend(result["errors"])
+    server.stop()
+
+    return {
+        "runs": args.runs,
+        "reruns": args.reruns,
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+        "memory_per_session": None, # Not measured here, kept for findRegressions()
+        "errors": errors,
+    }
+
+def printResults(results):
+    print(f"{results['runs']} cold starts, {results['reruns']} reruns each")
+    print(f"{'stage':>14} | {'count':>5} | {'p50 (ms)':>9} | {'p95 (ms)':>9}")
+    for stage, stats in results["stages"].items():
+        print(f"{stage:>14} | {stats['count']:>5} | {stats['p50'] * 1000:>9.1f} | {stats['p95'] * 1000:>9.1f}")
+    for error in results["errors"]:
+        print(f"Error: {error}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start and per-rerun timing of the storybot, against a local stand-in for the OpenAI API.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of cold starts (each in a fresh process)")
+    parser.add_argument("--reruns", type=int, default=10, help="Reruns timed per cold start, on the login page and on the dashboard")
+    parser.add_argument("--think-time", type=float, default=3.0, help="Seconds between the login page and the login (typing in the API key)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 slowdown compared to the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    results = runBenchmark(args)
+    printResults(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = findRegressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Benchmark: chat history trimming
+#
+# Measures how long reduceChatHistoryLength() takes for chat histories of 10 to 1,000 turns, compared to the previous implementation that re-rendered
+# and re-tokenized the whole prompt every time it dropped a message. Run it from the repository root with:
+#
+#   python benchmarks/bench_trim.py
+#
+# Note: tiktoken needs to be able to load the encoding for the selected model (it is downloaded and cached on first use).
+
+import os
+import sys
+import time
+import logging
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+logging.getLogger("streamlit").setLevel(logging.ERROR) # Silence the 'missing ScriptRunContext' warnings of streamlit's bare mode
+
+import streamlit as st
+import tiktoken
+import storybot
+
+for name in list(logging.root.manager.loggerDict): # Streamlit sets the level of each of its loggers individually
+    if name.startswith("streamlit"):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+TURNS = [10, 50, 100, 250, 500, 1000]
+REPEATS = 5
+MODEL = "gpt-4-turbo"
+LEGACY_MAX_TURNS = 250 # Beyond this, the legacy implementation takes minutes per call, so it is skipped
+
+# A story fragment of typical length, so that longer histories actually have to be trimmed to stay below 4,000 tokens.
+STORY = "Once upon a time, a little dragon named Pip was afraid of the dark. Every night, he hid under his mossy blanket and counted the stars through a hole in the cave roof. " * 3
+
+# The stage-1 template of the previous implementation, as it was formatted back then (a single text prompt, indentation included). The prompt templates of the
+# app have since become chat messages, so the text is frozen here to keep the baseline unchanged (the same text as in bench_prompt_tokens.py).
+LEGACY_TEMPLATE = """
+        You are a chatbot whose sole purpose is to write bedtime stories for younger children. If the user input is not related to a story, you kindly direct them to giving input for a bedtime story.
+        Your output must at all times be child-friendly, easy to understand for a young audience, and exciting to read. 
+        It should not contain difficult words and should be written in a bedtime story style.
+        Your answers should be structured in a JSON format, and include the following keys: 'story', 'dalle-prompt', 'opt1', 'opt2', 'opt3'.
+        'story' is your story fragment, which must contain a small cliffhanger at the end to allow the story to be continued. The story MUST relate to the story parts previously generated during the conversation listed under "chat history" and must not contain any plotholes.
+        'dalle-prompt' is a shorter prompt summarizing the current story part for a future dall-e prompt. 
+        The 'opt1', 'opt2', 'opt3' keys should contain keywords of 1 to 3 words, suggesting how the story could continue.
+        IF YOU FIND THAT THE USER MENTIONS TO END THE STORY IN THE CHAT HISTORY, WRITE A HAPPY END WITH NO FURTHER CLIFFHANGERS INSTEAD FOR THE 'STORY' VALUE AND MAKE SURE TO END ON "THE END". IN THIS CASE, DO NOT INCLUDE ANY 'OPT' KEYS IN YOUR ANSWER.
+
+        User Input: {userprompt}
+
+        Chat History: {chathistory}
+        """
+
+# The previous implementation of reduceChatHistoryLength(), kept here as the baseline for comparison.
+def legacyReduce(user_prompt, max_tokens=4000):
+    chat_history = st.session_state.chat_history[1:]
+    encoding = tiktoken.encoding_for_model(st.session_state.gpt_model)
+    total_tokens = len(encoding.encode(" ".join(LEGACY_TEMPLATE.format(chathistory = chat_history, userprompt= user_prompt))))
+    while total_tokens > max_tokens and len(chat_history) > 1:
+        chat_history.pop(0)
+        total_tokens = len(encoding.encode(" ".join(LEGACY_TEMPLATE.format(chathistory = chat_history, userprompt= user_prompt))))
+    return chat_history
+
+def setupSession(turns):
+    st.session_state.gpt_model = MODEL
+    st.session_state.conv_stage = 1
+    st.session_state.chat_history = []
+    st.session_state.token_ledger = False
+    # A summary job that never finishes, so no background summary is started and the trimming itself is measured
+    st.session_state.story_summary = {'text': "", 'covered': 0, 'job': {'future': Future(), 'covered': 0}}
+    storybot.introMessage()
+    for i in range(turns):
+        storybot.addMessage("user", f"Turn {i}: what happens next?")
+        storybot.addMessage("assistant", STORY)
+
+def timeIt(fn, *args, repeats=REPEATS):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def main():
+    print(f"{'turns':>6} | {'legacy (ms)':>12} | {'ledger (ms)':>12} | {'kept msgs':>9} | {'tokens':>6}")
+    for turns in TURNS:
+        setupSession(turns)
+        legacy = f"{timeIt(legacyReduce, 'The dragon finds a lantern.', repeats=1):.2f}" if turns <= LEGACY_MAX_TURNS else "skipped" # One run is plenty for the slow legacy path
+        ledger_ms = timeIt(storybot.reduceChatHistoryLength, "The dragon finds a lantern.")
+        kept = len(storybot.reduceChatHistoryLength("The dragon finds a lantern."))
+        print(f"{turns:>6} | {legacy:>12} | {ledger_ms:>12.2f} | {kept:>9} | {st.session_state.prompt_token_len:>6}", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Local stand-in for the OpenAI API
+#
+# A tiny HTTP server that answers the OpenAI endpoints the storybot uses (/v1/models, /v1/moderations, /v1/chat/completions and /v1/images/generations, plus the legacy /v1/engines)
+# with canned responses, after a configurable delay and with a configurable error rate. This allows load testing the app without spending any money.
+# Point the app to it by setting OPENAI_BASE_URL, e.g.:
+#
+#   python benchmarks/fake_openai.py --port 8787 --latency 0.5 --image-latency 2
+#   OPENAI_BASE_URL=http://127.0.0.1:8787/v1 streamlit run storybot.py
+#
+# Any API key is accepted. Every request is recorded (endpoint, duration, status and API key), see FakeOpenAIServer.stats().
+
+import io
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image
+
+# The canned story answer. It contains all keys the stage-0 and stage-1 templates ask for.
+STORY_RESPONSE = {
+    "story": "Once upon a time, in a castle on a hill, a little dragon named Pip was afraid of the dark. One night, a strange light appeared in the window... What do you think it was?",
+    "dalle-prompt": "A little dragon looking at a glowing window in a castle at night, storybook style",
+    "end": False,
+    "opt1": "A firefly",
+    "opt2": "A lantern",
+    "opt3": "A star",
+}
+
+# A small placeholder picture, generated once and returned for every image request.
+def makePlaceholderImage():
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (70, 60, 140)).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class FakeOpenAIServer:
+    # latency: delay of moderation/engines requests (seconds), completion_latency: delay before the first token of a completion, token_latency: delay between
+    # streamed tokens, image_latency: delay of image requests, error_rate: share of requests (0..1) answered with a 500 error instead.
+    # model_latency: completion_latency per model (e.g. {"gpt-3.5-turbo": 0.3}), stall_rate: share of completions (0..1) that stall for stall_latency extra seconds,
+    # image_tier_latency: image_latency per model and size (e.g. {("dall-e-2", "256x256"): 1.0}).
+    def __init__(self, host="127.0.0.1", port=0, latency=0.2, completion_latency=1.0, token_latency=0.01, image_latency=3.0, error_rate=0.0, seed=None,
+                 model_latency=None, stall_rate=0.0, stall_latency=10.0, image_tier_latency=None):
+        self.latency = latency
+        self.completion_latency = completion_latency
+        self.model_latency = dict(model_latency or {})
+        self.stall_rate = stall_rate
+        self.stall_latency = stall_latency
+        self.image_tier_latency = dict(image_tier_latency or {})
+        self.token_latency = token_latency
+        self.image_latency = image_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.image_b64 = makePlaceholderImage()
+        self.records = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self.makeHandler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def record(self, endpoint, duration, status, api_key):
+        with self.lock:
+            self.records.append({"endpoint": endpoint, "duration": duration, "status": status, "api_key": api_key})
+
+    # Returns the number of requests and errors per endpoint. Requests made with API keys starting with skip_key_prefix are left out (e.g. warm-up requests).
+    def stats(self, skip_key_prefix=None):
+        with self.lock:
+            records = [record for record in self.records if not (skip_key_prefix and record["api_key"].startswith(skip_key_prefix))]
+        stats = {}
+        for record in records:
+            entry = stats.setdefault(record["endpoint"], {"requests": 0, "errors": 0})
+            entry["requests"] += 1
+            entry["errors"] += record["status"] >= 400
+        return stats
+
+    def shouldFail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    # Delay before the first token of a completion by the given model, including the occasional stall.
+    def getCompletionLatency(self, model):
+        with self.lock:
+            stalled = self.random.random() < self.stall_rate
+        return self.model_latency.get(model, self.completion_latency) + (self.stall_latency if stalled else 0.0)
+
+    def makeHandler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args): # Keep the console quiet
+                pass
+
+            def sendJson(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def readJson(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def handle_request(self, method):
+                start = time.perf_counter()
+                endpoint = self.path.split("?")[0].rstrip("/")
+                if endpoint.startswith("/v1/models/"): # Single model lookups are recorded together with the model listing
+                    endpoint = "/v1/models"
+                body = self.readJson() if method == "POST" else {}
+                status = 200
+                try:
+                    if endpoint not in ("/v1/engines", "/v1/models", "/v1/moderations", "/v1/chat/completions", "/v1/images/generations"):
+                        status = 404
+                        self.sendJson(404, {"error": {"message": f"Unknown endpoint {endpoint}", "type": "invalid_request_error"}})
+                    elif server.shouldFail():
+                        time.sleep(server.latency)
+                        status = 500
+                        self.sendJson(500, {"error": {"message": "The server had an error while processing your request.", "type": "server_error"}})
+                    elif endpoint in ("/v1/engines", "/v1/models"):
+                        time.sleep(server.latency)
+                        if self.path.startswith("/v1/models/"):
+                            self.sendJson(200, {"id": self.path.split("/")[-1], "object": "model", "owned_by": "openai"})
+                        else:
+                            self.sendJson(200, {"object": "list", "data": [{"id": "gpt-4-turbo", "object": "model"}]})
+                    elif endpoint == "/v1/moderations":
+                        time.sleep(server.latency)
+                        inputs = body.get("input", "")
+                        inputs = inputs if isinstance(inputs, list) else [inputs]
+                        self.sendJson(200, {"id": "modr-fake", "model": "text-moderation-latest",
+                                            "results": [{"flagged": False, "categories": {}, "category_scores": {}} for _ in inputs]})
+                    elif endpoint == "/v1/images/generations":
+                        time.sleep(server.image_tier_latency.get((body.get("model"), body.get("size")), server.image_latency))
+                        self.sendJson(200, {"created": int(time.time()), "data": [{"b64_json": server.image_b64, "revised_prompt": body.get("prompt", "")}]})
+                    else:
+                        self.sendCompletion(body)
+                finally:
+                    server.record(endpoint, time.perf_counter() - start, status, self.headers.get("Authorization", "").removeprefix("Bearer "))
+
+            def sendCompletion(self, body):
+                model = body.get("model", "gpt-4-turbo")
+                time.sleep(server.getCompletionLatency(model))
+                content = json.dumps(STORY_RESPONSE)
+                usage = {"prompt_tokens": 500, "completion_tokens": 100, "total_tokens": 600}
+                if not body.get("stream"):
+                    self.sendJson(200, {"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": model, "usage": usage,
+                                        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}]})
+                    return
+                # Streamed completion (server-sent events), a few characters per chunk
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                pieces = [content[i:i + 8] for i in range(0, len(content), 8)]
+                for i, piece in enumerate(pieces):
+                    chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                             "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece} if i == 0 else {"content": piece}, "finish_reason": None}]}
+                    self.writeChunk(f"data: {json.dumps(chunk)}\n\n")
+                    if server.token_latency and i < len(pieces) - 1:
+                        time.sleep(server.token_latency)
+                final = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+                self.writeChunk(f"data: {json.dumps(final)}\n\n")
+                self.writeChunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def writeChunk(self, text):
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_POST(self):
+                self.handle_request("POST")
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI API endpoints used by the storybot.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=0.2, help="Delay of moderation and engines requests in seconds")
+    parser.add_argument("--completion-latency", type=float, default=1.0, help="Delay before the first token of a completion in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="Delay between streamed chunks in seconds")
+    parser.add_argument("--image-latency", type=float, default=3.0, help="Delay of image requests in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500 error (0..1)")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SECONDS", help="Completion latency of a single model, e.g. gpt-3.5-turbo=0.3")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Share of completions (0..1) that stall for --stall-latency extra seconds")
+    parser.add_argument("--stall-latency", type=float, default=10.0, help="Extra delay of a stalled completion in seconds")
+    args = parser.parse_args()
+
+    model_latency = {model: float(seconds) for model, _, seconds in (override.partition("=") for override in args.model_latency)}
+    server = FakeOpenAIServer(args.host, args.port, args.latency, args.completion_latency, args.token_latency, args.image_latency, args.error_rate,
+                              model_latency=model_latency, stall_rate=args.stall_rate, stall_latency=args.stall_latency).start()
+    print(f"Fake OpenAI API listening on {server.base_url} (Ctrl+C to stop)")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Offline load test
+#
+# Starts the local OpenAI stand-in (fake_openai.py), points the app to it and drives storybot.py with Streamlit's AppTest for a number of concurrent
+# simulated parents, each logging in and writing a story of a few turns. Afterwards, it reports p50/p95 latencies per stage and the memory used per session.
+# AppTest is not thread-safe, so every simulated parent runs in a process of its own.
+# Run it from the repository root, e.g.:
+#
+#   python benchmarks/load_test.py --parents 10 --turns 4 --image-latency 2
+#   python benchmarks/load_test.py --json results.json                      # Save the results ...
+#   python benchmarks/load_test.py --baseline results.json --tolerance 0.2  # ... and fail if a p95 got more than 20% worse later on
+#
+# Before its session starts, every process logs in once with a warm-up key, so imports and one-time setup do not count towards the results.
+# Memory is measured with tracemalloc, which slows Python down noticeably. Use --no-memory for latency numbers that are closer to production.
+# Note: tiktoken needs to be able to load the encoding for the selected model (it is downloaded and cached on first use).
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tracemalloc
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+STORYBOT_PATH = os.path.join(BENCHMARK_DIR, "..", "storybot.py")
+sys.path.insert(0, BENCHMARK_DIR)
+WARMUP_KEY = "sk-warmup"
+
+from streamlit.testing.v1 import AppTest
+from fake_openai import FakeOpenAIServer
+
+THEMES = ["a dragon who is afraid of the dark", "a knight riding towards a castle on a stormy night", "a bunny who wants to fly", "a lost star looking for home"]
+
+
+# Silences the 'missing ScriptRunContext' warnings of streamlit's bare mode (streamlit sets the level of each of its loggers individually).
+def quietStreamlit():
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+def percentile(samples, share):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+def summarize(samples):
+    return {"count": len(samples), "p50": percentile(samples, 0.5), "p95": percentile(samples, 0.95), "mean": statistics.fmean(samples) if samples else float("nan")}
+
+
+# A single simulated parent: logs in, writes a story of the given number of turns (clicking the first suggestion once there are any) and waits for every picture.
+# Returns the timings of each stage, the errors shown by the app and the memory allocated by the session.
+def simulateParent(index, turns, image_timeout, trace_memory):
+    quietStreamlit()
+    samples, errors = {}, []
+    def record(stage, seconds):
+        samples.setdefault(stage, []).append(seconds)
+
+    # Warm-up session, not counted (its requests are filtered out by their API key)
+    warmup = AppTest.from_file(STORYBOT_PATH, default_timeout=120)
+    warmup.run()
+    warmup.text_input[0].input(WARMUP_KEY)
+    warmup.button[0].click().run()
+    warmup.run()
+    del warmup
+    if trace_memory:
+        tracemalloc.start()
+
+    at = AppTest.from_file(STORYBOT_PATH, default_timeout=120)
+    start = time.perf_counter()
+    at.run()
+    record("render", time.perf_counter() - start)
+
+    at.text_input[0].input(f"sk-fake-parent-{index}")
+    start = time.perf_counter()
+    at.button[0].click().run()
+    record("login", time.perf_counter() - start)
+    if not at.session_state.logged_in:
+        return {"samples": samples, "errors": [f"parent {index}: login failed"], "memory": None}
+    at.run()
+
+    for turn in range(turns):
+        images_before = len(at.session_state.image_urls)
+        buttons = at.session_state.prompt_buttons
+        start = time.perf_counter()
+        suggestion = [button for button in at.button if buttons and button.label == buttons[0]]
+        if suggestion:
+            suggestion[0].click().run()
+        else:
+            at.chat_input[0].set_value(THEMES[index % len(THEMES)] if turn == 0 else "What happens next?").run()
+        record("turn", time.perf_counter() - start)
+        if at.error or at.exception:
+            errors.extend(f"parent {index}, turn {turn}: {element.value}" for element in list(at.error) + list(at.exception))
+            continue
+
+        # Keep rerunning (as the picture window fragment would) until the picture of this turn is there.
+        deadline = time.perf_counter() + image_timeout
+        while len(at.session_state.image_urls) <= images_before and at.session_state.image_jobs and time.perf_counter() < deadline:
+            time.sleep(0.1)
+            rerun_start = time.perf_counter()
+            at.run()
+            record("rerun", time.perf_counter() - rerun_start)
+        if len(at.session_state.image_urls) > images_before:
+            record("image", time.perf_counter() - start)
+        else:
+            errors.append(f"parent {index}, turn {turn}: no picture")
+
+    memory = tracemalloc.get_traced_memory()[0] if trace_memory else None # The session (at) is still alive here
+    tracemalloc.stop()
+    return {"samples": samples, "errors": errors, "memory": memory}
+
+
+def runLoadTest(args):
+    server = FakeOpenAIServer(latency=args.latency, completion_latency=args.completion_latency, token_latency=args.token_latency,
+                              image_latency=args.image_latency, error_rate=args.error_rate, seed=args.seed).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url # Inherited by the worker processes
+
+    samples, errors, memory = {}, [], []
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.parents) as pool:
+        futures = [pool.submit(simulateParent, i, args.turns, args.image_timeout, args.memory) for i in range(args.parents)]
+        for future in futures:
+            result = future.result()
+            for stage, values in result["samples"].items():
+                samples.setdefault(stage, []).extend(values)
+            errors.extend(result["errors"])
+            if result["memory"] is not None:
+                memory.append(result["memory"])
+    duration = time.perf_counter() - started
+    server.stop()
+
+    # Upstream latencies, as seen by the fake server
+    upstream = {"moderation": "/v1/moderations", "completion": "/v1/chat/completions", "image request": "/v1/images/generations", "key check": "/v1/models"}
+    for stage, endpoint in upstream.items():
+        samples[stage] = [record["duration"] for record in server.records if record["endpoint"] == endpoint and not record["api_key"].startswith(WARMUP_KEY)]
+
+    return {
+        "parents": args.parents,
+        "turns": args.turns,
+        "duration": duration,
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+        "requests": server.stats(skip_key_prefix=WARMUP_KEY),
+        "memory_per_session": statistics.fmean(memory) if memory else None,
+        "errors": errors,
+    }
+
+def printResults(results):
+    print(f"{results['parents']} parents x {results['turns']} turns in {results['duration']:.1f}s")
+    print(f"{'stage':>14} | {'count':>5} | {'p50 (ms)':>9} | {'p95 (ms)':>9}")
+    for stage, stats in results["stages"].items():
+        print(f"{stage:>14} | {stats['count']:>5} | {stats['p50'] * 1000:>9.1f} | {stats['p95'] * 1000:>9.1f}")
+    if results["memory_per_session"] is not None:
+        print(f"Memory per session: {results['memory_per_session'] / 1024:.1f} KiB")
+    for endpoint, stats in results["requests"].items():
+        print(f"{endpoint}: {stats['requests']} requests, {stats['errors']} errors")
+    for error in results["errors"]:
+        print(f"Error: {error}")
+
+# Compares the p95 latencies to an earlier run and returns the stages that got slower by more than the given tolerance.
+def findRegressions(results, baseline, tolerance):
+    regressions = []
+    for stage, stats in results["stages"].items():
+        before = baseline["stages"].get(stage)
+        if before and before["count"] and stats["count"] and stats["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append(f"{stage}: p95 {before['p95'] * 1000:.1f}ms -> {stats['p95'] * 1000:.1f}ms")
+    if results["memory_per_session"] and baseline["memory_per_session"] and results["memory_per_session"] > baseline["memory_per_session"] * (1 + tolerance):
+        regressions.append(f"memory per session: {baseline['memory_per_session'] / 1024:.1f} KiB -> {results['memory_per_session'] / 1024:.1f} KiB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the storybot against a local stand-in for the OpenAI API.")
+    parser.add_argument("--parents", type=int, default=5, help="Number of concurrent simulated parents")
+    parser.add_argument("--turns", type=int, default=3, help="Story turns per parent")
+    parser.add_argument("--latency", type=float, default=0.2, help="Delay of moderation and engines requests in seconds")
+    parser.add_argument("--completion-latency", type=float, default=1.0, help="Delay before the first token of a completion in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="Delay between streamed chunks in seconds")
+    parser.add_argument("--image-latency", type=float, default=3.0, help="Delay of image requests in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of upstream requests answered with a 500 error (0..1)")
+    parser.add_argument("--image-timeout", type=float, default=60.0, help="Seconds to wait for a picture before counting it as missing")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the error injection")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Do not trace memory (faster, more realistic latencies)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 slowdown compared to the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    quietStreamlit()
+    results = runLoadTest(args)
+    printResults(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = findRegressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
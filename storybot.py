@@ -9,29 +9,186 @@
 
 ### * 01 IMPORTS * ###
 # All these imports are needed to either display the app correctly, make requests to the API, work with OpenAI, generate custom prompts, 
+# The heavy packages (openai, langchain and tiktoken) are not imported here, but only by the functions that need them (see getPromptTemplates(), getClients(), getEncoding(), ...).
+# They take seconds to import, and the login page does not need any of them, so it shows up right away on a cold start.
 
+import os # File paths for the local response cache
+import json # Serializing cached responses
+import sqlite3 # Local response cache
 import random # Random Number generator for choosing a random intro message
+import time # Timestamps for evicting idle API clients
+import io # In-memory buffers for downscaling images
+import base64 # Decoding images returned by the API as base64
+import hashlib # Hashing API keys, so they are never used as plain dictionary keys
+import hmac # Salted hashes of API keys
+import threading # Lock protecting the shared client pool
+import functools # Wrapping functions with timing spans
+import email.utils # Parsing Retry-After headers given as a date
+import zlib # Compressing stories in the session store
+import dbm # Local key-value session store
+import struct # Timestamps of stories in the key-value session store
+import secrets # Random story ids
+from collections import OrderedDict # Least recently used stories in the in-memory session store
+from collections import deque # Bounded per-session telemetry buffers
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler # Local metrics endpoint (Prometheus text format)
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED # Thread pool for generating images in the background, racing hedged requests
+import queue # Handing a streamed answer over from its thread (hedged streams)
+import textwrap # Removing the indentation of the prompt instructions
 import streamlit as st # Streamlit App functionality
+from streamlit.runtime.scriptrunner import get_script_run_ctx # Tells whether code runs in a session (script thread) or in a background thread
 import requests # API Requests
-from openai import OpenAI # OpenAI API Interface
-from langchain_openai import ChatOpenAI # OpenAI for Langchain Functions
-from langchain.prompts import PromptTemplate # Prompt Template Package for custom Prompting
-from langchain_core.output_parsers import JsonOutputParser # Package for interpreting OpenAI responses as JSON objects for further processing
-import tiktoken # Helper package to calculate # of tokens needed
+from PIL import Image # Downscaling generated images to thumbnails (Pillow comes with streamlit)
 
 
 ### * 02 FINAL VARIABLES * ###
 # This section contains all final variables referenced at a later stage in the program.
 
 setup_link = "https://platform.openai.com/docs/quickstart/account-setup" # Used in the login page to guide the user to create an API key, if not already done so
+openai_base_url = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1") # Base url of the OpenAI API. Can be pointed to a local stand-in (see benchmarks/fake_openai.py) for testing
 
 # To be able to initialize the session state variables in a loop, this list references all keys to be initialized.
-sessionStateKeys = ['logged_in', 'toast_msg', 'conversation_stage', 'dalle_task', 'prompt_disabled', 'prompt_callback']
+sessionStateKeys = ['logged_in', 'toast_msg', 'conversation_stage', 'prompt_callback']
 
 # The app allows the user to choose the GPT model it should use for generating the stories. The options, however, are limited to these three (two) models to keep things relatively simple.
 gpt_model_options = ['gpt-4-turbo', 'gpt-4', 'gpt-3.5-turbo']
 dalle_model_options = ['dall-e-2', 'dall-e-3']
 
+# How the answers of each model are kept to the keys of the prompt templates (see getResponseFormat()): 'json_schema' (structured output, the answer follows the schema
+# of the conversation stage exactly), 'json_object' (JSON mode, the answer is valid JSON) or None (the model is only asked for JSON in the prompt). Models that are not
+# listed here, e.g. newer ones added to gpt_model_options, get 'json_schema'.
+response_formats = {'gpt-4-turbo': 'json_object', 'gpt-4': None, 'gpt-3.5-turbo': 'json_object'}
+
+# Tokens every chat message adds to a prompt on top of its content (role and separators), and tokens priming the answer, see countMessageTokens().
+message_token_overhead = 4
+reply_token_overhead = 3
+
+# Number of images that can be generated in parallel in the background, shared by all sessions served by this process.
+image_worker_count = 4
+
+# The API key check uses a single pooled HTTP session with connect/read timeouts (in seconds), and remembers its results for a while, so repeated logins
+# with the same key (e.g. on a shared tablet) do not have to ask OpenAI again. Rejected keys are only remembered briefly, in case the user fixes their account.
+key_check_timeout = (3.05, 10)
+key_check_ttl = 10 * 60
+key_check_negative_ttl = 60
+key_check_cache_size = 1000
+
+# All OpenAI requests go through a shared scheduler (see scheduleCall()), which keeps to the rate limits of each API key, so many sessions sharing one key get smooth
+# throughput instead of bursts of failures. Limits are given per kind of request as (requests per minute, tokens per minute), None meaning not limited.
+# Rate limit errors and transient server errors are retried with jittered exponential backoff (honoring the Retry-After header of the API).
+rate_limits = {
+    'completion': (500, 30000),
+    'moderation': (1000, None),
+    'image': (5, None),
+}
+max_concurrent_requests = 8 # Per API key
+max_retries = 4
+backoff_base = 1.0 # Seconds before the first retry, doubled for every further retry
+backoff_max = 30.0
+completion_token_estimate = 600 # Expected length of a story answer, reserved from the token budget together with the prompt
+
+# Model routing (see routeModel()): every completion request names its task, which decides the model it goes to. The story parts are written by the model selected
+# in the sidebar ('selected'), while the story openers (stage 0), which the parent waits for, and the background summaries go to the fastest model ('fastest'): the model
+# with the lowest median latency of the recent story requests of this process, or fast_model as long as there are fewer than latency_min_samples latencies of it.
+model_routes = {
+    'opener': 'fastest',
+    'story': 'selected',
+    'summary': 'fastest',
+}
+fast_model = 'gpt-3.5-turbo'
+latency_window = 200 # Recent latencies kept per model (and metric)
+latency_min_samples = 20
+
+# Hedged requests (opt-in in the sidebar): if a story request has not answered by its deadline, a backup request is sent to the fastest model, and whichever answer
+# arrives first (as valid JSON) is used, the other one is thrown away. The deadline is hedge_factor times the p95 latency of the model (time to the first words for
+# streamed answers), or hedge_default_deadline seconds as long as there are too few latencies of the model.
+hedge_factor = 1.0
+hedge_default_deadline = 10.0
+hedge_worker_count = 32 # Shared by all sessions, a hedged request takes up to three of them (the request, the backup and the thread reading a stream)
+
+# API clients are kept alive across reruns (see getClients()). Clients that have not been used for this many seconds are removed from the pool.
+client_idle_ttl = 30 * 60
+
+# Settings of the (opt-in) local response cache for story completions and images. The cache is a SQLite file next to this script, which is kept below cache_max_bytes
+# by evicting the least recently used entries.
+cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "storybot_cache.sqlite")
+cache_max_bytes = 50 * 1024 * 1024
+
+# Picture tiers (model, size, quality): every picture is painted with the tier of the DALL-E model selected in the sidebar. With "Progressive pictures" turned on in the
+# sidebar, a quick preview is painted with image_preview_tier at the same time, which is shown as soon as it is ready and then replaced in place by the full-quality picture.
+image_tiers = {
+    'dall-e-2': ('dall-e-2', '1024x1024', 'standard'),
+    'dall-e-3': ('dall-e-3', '1024x1024', 'standard'),
+}
+image_preview_tier = ('dall-e-2', '256x256', 'standard')
+
+# Generated images are downloaded once and stored locally (DALL-E image urls expire after about an hour). The picture window only shows downscaled thumbnails,
+# which keeps every rerun quick no matter how many pictures the story already has. While pictures are being painted, the picture window checks for finished ones
+# every image_poll_interval seconds. The image store is kept below image_store_max_bytes by deleting the least recently stored pictures (see storeImage()), no matter
+# whether they belong to a story, the response cache, or a story that has been reset or has expired.
+image_store_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "images")
+image_store_max_bytes = 1024 * 1024 * 1024
+thumbnail_size = 384
+image_poll_interval = 1
+
+# Long stories are kept within a fixed token budget by a rolling summary: as soon as the messages that have not been summarized yet take up more than summary_trigger_tokens,
+# all but the most recent summary_keep_tokens worth of them are compressed into the running summary of the story, in the background and with the fastest model (see model_routes).
+summary_trigger_tokens = 1500
+summary_keep_tokens = 750
+
+# Prefetching (opt-in in the sidebar): while the parent reads a story part, the continuations for all three suggestion buttons are already generated in the background,
+# so clicking a button shows the next part right away. The branches that were not chosen are thrown away. To keep this from getting expensive, every session can only
+# spend prefetch_token_budget tokens on prefetching. If prefetch_images is turned on, the pictures of the continuations are prefetched, too (that is a lot pricier).
+prefetch_token_budget = 30000
+prefetch_images = False
+prefetch_worker_count = 6
+
+# Server-side session store: the story of every session (chat history, pictures, suggestions, conversation stage and summary) is also kept in a store, under a random
+# story id that is part of the page url. A parent whose connection dropped (or who ended up on another replica behind a load balancer) logs in again and continues
+# the same story. Between two runs, a session only holds the id of its story: the story is read from the store at the start of a run and released to it at the end
+# (see loadStory() and releaseStory()), so idle sessions only take up the space of their packed (compressed) story in the store. The store is chosen with STORYBOT_SESSION_STORE:
+#   'memory' (default): an in-memory LRU of packed stories, the least recently used beyond session_memory_size are spilled to a SQLite file. Resuming only works on the same replica.
+#   'sqlite': every story is written to a SQLite file, which can be shared by several processes on a host.
+#   'kv': every story is written to a local key-value file (dbm), standing in for a shared key-value store such as Redis.
+# Stories are tied to the salted hash of their owner's API key, and the salt is random per process unless STORYBOT_KEY_SALT is set. With the 'sqlite' and 'kv' stores,
+# set STORYBOT_KEY_SALT (any secret string) to resume stories after a restart of the app.
+# For resuming on other replicas, the store file and the local image store (image_store_path) need to be on storage shared by the replicas, and the replicas need
+# the same STORYBOT_KEY_SALT (see hashApiKey()).
+session_store = os.environ.get("STORYBOT_SESSION_STORE", "memory")
+session_store_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "storybot_sessions")
+session_memory_size = 500
+session_store_ttl = 7 * 24 * 60 * 60 # Stories that have not been touched for a week are deleted
+storyStateKeys = ['chat_history', 'token_ledger', 'story_summary', 'image_urls', 'prompt_buttons', 'conv_stage', 'prompt_token_len']
+
+# Telemetry: every turn records timing spans, token counts and an estimated cost, which are shown in the sidebar debug panel. Additionally, the spans and turns can be
+# exported as JSON lines (set STORYBOT_TELEMETRY_FILE to a file path) and as Prometheus metrics on a local endpoint (set STORYBOT_METRICS_PORT to a port number).
+telemetry_file = os.environ.get("STORYBOT_TELEMETRY_FILE")
+metrics_port = os.environ.get("STORYBOT_METRICS_PORT")
+telemetry_history = 200 # Number of spans kept per session for the debug panel
+
+# Prices in $ per 1,000 tokens (prompt, completion) and per image, used for the cost estimate in the telemetry.
+model_prices = {
+    'gpt-4-turbo': (0.01, 0.03),
+    'gpt-4': (0.03, 0.06),
+    'gpt-3.5-turbo': (0.0005, 0.0015),
+}
+image_prices = { # Per picture tier (model, size, quality)
+    ('dall-e-2', '256x256', 'standard'): 0.016,
+    ('dall-e-2', '512x512', 'standard'): 0.018,
+    ('dall-e-2', '1024x1024', 'standard'): 0.02,
+    ('dall-e-3', '1024x1024', 'standard'): 0.04,
+    ('dall-e-3', '1024x1024', 'hd'): 0.08,
+    ('dall-e-3', '1024x1792', 'standard'): 0.08,
+    ('dall-e-3', '1792x1024', 'standard'): 0.08,
+    ('dall-e-3', '1024x1792', 'hd'): 0.12,
+    ('dall-e-3', '1792x1024', 'hd'): 0.12,
+}
+
+# If speculative moderation is turned on, the moderation of the user input runs at the same time as the completion request instead of before it.
+# If the input is flagged, the completion is thrown away and the prompt never makes it into the chat history, so the safety guarantee stays the same.
+speculative_moderation = True
+moderation_worker_count = 8 # Moderation requests are short, so a few more of them can run in parallel
+moderation_timeout = 60.0 # Seconds a turn waits for a moderation result (retries included) before it fails with an error
+
 # These are the placeholder prompts used in the chat input field. Depending on the conversation stage, the messages ask the user to do different things.
 chatInputPrompts = [
     'Start off your journey by entering the first few lines of a story, or give me a general theme.',
@@ -39,6 +196,10 @@ chatInputPrompts = [
     'How should we continue? Use one of the suggestions above, or write some manual input.'
 ]
 
+# Warnings shown in the chat window if the moderation flags either the user input or the story generated by the assistant.
+flaggedInputWarning = "Sorry, this prompt violates OpenAI's content policies and might not be suitable for children. It has not been added to your chat history. Please choose a different prompt."
+flaggedOutputWarning = "Sorry, BedtimeBuddy came up with a story part that might not be suitable for children. It has been discarded and not added to your chat history. Please try again or choose a different prompt."
+
 # The initial message from the AI chatbot is hardcoded to waste as little tokens as possible. To not make the experience too boring for the user, the chat will pick one of these variations at random.
 aiIntroMessages = [
     "Hey! I'm Bedtime Buddy, your bedtime storyteller. Do you want to hear a new adventure? Just tell me a few things you like, and I'll start a story for you!",
@@ -53,57 +214,287 @@ aiIntroMessages = [
 ### * 03 PROMPT TEMPLATES * ###
 # These templates are used by langchain to invoke prompts on the selected LLM. As the different stages of the chat have different requirements, I use different prompt templates.
 # The prompt templates are returned by a function called 'getPromptTemplate' based on the conversation stage the chat is in.
+# Only their definitions live here: the langchain ChatPromptTemplate objects are built once per process by getPromptTemplates(), instead of on every rerun of the script.
+# Every prompt is a list of chat messages: the fixed instructions (system message) come first, so requests of all stories share the same prefix (which the API can cache),
+# followed by the story so far as real user and assistant messages (stage 1 only) and the user prompt. The answer keys ('schema') are sent along as a JSON schema
+# to the models that support structured output (see response_formats), the other models are asked for plain JSON.
 
 promptTemplates = [
-    PromptTemplate( # STAGE 0 - START OF A STORY, ASKING FOR FOLLOW-UP (NO BUTTONS)
-        input_variables=["userprompt","chathistory"],
-        template="""
+    dict( # STAGE 0 - START OF A STORY, ASKING FOR FOLLOW-UP (NO BUTTONS)
+        system="""
         You are a chatbot whose sole purpose is to write bedtime stories for younger children. If the user input is not related to a story, you kindly direct them to giving input for a bedtime story.
-        Your output must at all times be child-friendly, easy to understand for a young audience, and exciting to read. 
+        Your output must at all times be child-friendly, easy to understand for a young audience, and exciting to read.
         It should not contain difficult words and should be written in a bedtime story style.
         Your answers should be structured in a JSON format, and include the following keys: 'story', 'dalle-prompt'.
-        'story' is your story fragment, which must contain a small cliffhanger at the end to allow the story to be continued. Only include the BEGINNING OF THE STORY in the value for 'story' together with a friendly question to the user asking for input on how the story should continue. 
+        'story' is your story fragment, which must contain a small cliffhanger at the end to allow the story to be continued. Only include the BEGINNING OF THE STORY in the value for 'story' together with a friendly question to the user asking for input on how the story should continue.
         'dalle-prompt' is a shorter prompt summarizing the current story part for a future dall-e prompt.
-
-        User Input: {userprompt}
         """,
+        history=False,
+        schema={'story': 'string', 'dalle-prompt': 'string'},
     ),
-    PromptTemplate( # STAGE 1 - CONTINUATION OF A STORY, ASKING FOR FOLLOW-UP (WITH BUTTONS)
-        input_variables=["userprompt","chathistory"],
-        template="""
+    dict( # STAGE 1 - CONTINUATION OF A STORY, ASKING FOR FOLLOW-UP (WITH BUTTONS)
+        system="""
         You are a chatbot whose sole purpose is to write bedtime stories for younger children. If the user input is not related to a story, you kindly direct them to giving input for a bedtime story.
-        Your output must at all times be child-friendly, easy to understand for a young audience, and exciting to read. 
+        Your output must at all times be child-friendly, easy to understand for a young audience, and exciting to read.
         It should not contain difficult words and should be written in a bedtime story style.
-        Your answers should be structured in a JSON format, and include the following keys: 'story', 'dalle-prompt', 'opt1', 'opt2', 'opt3'.
-        'story' is your story fragment, which must contain a small cliffhanger at the end to allow the story to be continued. The story MUST relate to the story parts previously generated during the conversation listed under "chat history" and must not contain any plotholes.
-        'dalle-prompt' is a shorter prompt summarizing the current story part for a future dall-e prompt. 
-        The 'opt1', 'opt2', 'opt3' keys should contain keywords of 1 to 3 words, suggesting how the story could continue.
-        IF YOU FIND THAT THE USER MENTIONS TO END THE STORY IN THE CHAT HISTORY, WRITE A HAPPY END WITH NO FURTHER CLIFFHANGERS INSTEAD FOR THE 'STORY' VALUE AND MAKE SURE TO END ON "THE END". IN THIS CASE, DO NOT INCLUDE ANY 'OPT' KEYS IN YOUR ANSWER.
-
-        User Input: {userprompt}
-
-        Chat History: {chathistory}
+        Your answers should be structured in a JSON format, and include the following keys: 'story', 'dalle-prompt', 'end', 'opt1', 'opt2', 'opt3'.
+        'story' is your story fragment, which must contain a small cliffhanger at the end to allow the story to be continued. The story MUST relate to the story parts previously written in this conversation (and the summary of the story so far, if there is one) and must not contain any plotholes.
+        'dalle-prompt' is a shorter prompt summarizing the current story part for a future dall-e prompt.
+        'end' is false, and the 'opt1', 'opt2', 'opt3' keys should contain keywords of 1 to 3 words, suggesting how the story could continue.
+        IF THE USER ASKS TO END THE STORY, WRITE A HAPPY END WITH NO FURTHER CLIFFHANGERS INSTEAD FOR THE 'STORY' VALUE AND MAKE SURE TO END ON "THE END". IN THIS CASE, SET 'END' TO TRUE AND LEAVE THE 'OPT' KEYS EMPTY.
         """,
+        history=True,
+        schema={'story': 'string', 'dalle-prompt': 'string', 'end': 'boolean', 'opt1': 'string', 'opt2': 'string', 'opt3': 'string'},
     ),
 ]
 
+# This template is used to compress older parts of a long story into a running summary (see updateStorySummary()), which then takes their place in the chat history.
+summaryTemplate = dict(
+    input_variables=["summary","chathistory"],
+    template="""
+    You summarize bedtime stories that are being written together with a child. Combine the summary of the story so far with the new chat messages below into one short summary.
+    Keep every fact that matters for the rest of the story: the names and traits of all characters, the places, the important events in order, and any open cliffhanger.
+    Leave out the wording of the story itself. Answer with the summary text only.
+
+    Summary so far: {summary}
+
+    New chat messages:
+    {chathistory}
+    """,
+)
+
 
 ### * 04 FUNCTIONS * ###
 # Helper functions and handling of chat requests, summarizing the contents, generating images, etc.
 
+# Thread-local storage used to hand the telemetry of a session over to the background threads working for it (see submitTraced()).
+telemetryContext = threading.local()
+
+# Function that returns the process-wide telemetry aggregates (span counts and durations, tokens and costs per model, routing decisions and the recent latencies
+# of each model), which are exported as Prometheus metrics. If STORYBOT_METRICS_PORT is set, the metrics endpoint is started together with it, once per process.
+@st.cache_resource(show_spinner=False)
+def getTelemetry():
+    telemetry = {'lock': threading.Lock(), 'spans': {}, 'tokens': {}, 'cost': {}, 'routes': {}, 'latencies': {}}
+    if metrics_port:
+        startMetricsServer(telemetry, int(metrics_port))
+    return telemetry
+
+# Function that returns the telemetry of the current session (a dict holding its recent spans and turns). Background threads get the telemetry of the session
+# that started them via the thread-local telemetryContext, and None if there is no session at all (e.g. in a batch run).
+def getSessionTelemetry():
+    if get_script_run_ctx() is None:
+        return getattr(telemetryContext, 'session', None)
+    if 'telemetry' not in st.session_state:
+        st.session_state.telemetry = {'spans': deque(maxlen=telemetry_history), 'turns': deque(maxlen=telemetry_history), 'routes': deque(maxlen=telemetry_history), 'turn': 0}
+    return st.session_state.telemetry
+
+# Helper function that appends a record to the JSON lines export, if it is turned on.
+exportLock = threading.Lock()
+def exportRecord(record):
+    if telemetry_file:
+        with exportLock, open(telemetry_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+# Function that records a timing span: in the session telemetry (for the debug panel, tagged with the turn it belongs to), in the process-wide aggregates and in the export.
+def recordSpan(name, duration, **attributes):
+    session = getSessionTelemetry()
+    span = {'type': 'span', 'name': name, 'duration': round(duration, 4), 'time': time.time(), **attributes}
+    if session is not None:
+        span['turn'] = getattr(telemetryContext, 'turn', None) if get_script_run_ctx() is None else session['turn']
+        session['spans'].append(span)
+    telemetry = getTelemetry()
+    with telemetry['lock']:
+        count, total = telemetry['spans'].get(name, (0, 0.0))
+        telemetry['spans'][name] = (count + 1, total + duration)
+    exportRecord(span)
+
+# Helper function that returns the estimated cost of the picture of a story part painted with a DALL-E model: the price of its tier, plus the preview if it is progressive.
+def getImageCost(image_model, progressive=False):
+    if image_model is None:
+        return 0.0
+    return image_prices.get(getImageTier(image_model), 0) + (image_prices.get(image_preview_tier, 0) if progressive else 0)
+
+# Function that records a finished story turn with its model, token counts and estimated cost (including the picture, see getImageCost()).
+def recordTurn(model, prompt_tokens, completion_tokens, image_model=None, progressive_image=False):
+    prompt_price, completion_price = model_prices.get(model, (0, 0))
+    image_cost = getImageCost(image_model, progressive_image)
+    cost = prompt_tokens / 1000 * prompt_price + completion_tokens / 1000 * completion_price + image_cost
+    session = getSessionTelemetry()
+    turn = {'type': 'turn', 'turn': session['turn'] if session is not None else None, 'time': time.time(), 'model': model, 'image_model': image_model,
+            'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'image_cost': round(image_cost, 5), 'cost': round(cost, 5)}
+    if session is not None:
+        session['turns'].append(turn)
+    telemetry = getTelemetry()
+    with telemetry['lock']:
+        for kind, tokens in (('prompt', prompt_tokens), ('completion', completion_tokens)):
+            telemetry['tokens'][(model, kind)] = telemetry['tokens'].get((model, kind), 0) + tokens
+        telemetry['cost'][model] = telemetry['cost'].get(model, 0) + cost
+    exportRecord(turn)
+
+# Function that records a routing decision (see routeModel() and hedgeRequest()): the task, the model it went to and why, e.g. 'selected', 'fastest' or 'hedge'.
+def recordRoute(task, model, reason, **attributes):
+    session = getSessionTelemetry()
+    route = {'type': 'route', 'task': task, 'model': model, 'reason': reason, 'time': time.time(), **attributes}
+    if session is not None:
+        route['turn'] = getattr(telemetryContext, 'turn', None) if get_script_run_ctx() is None else session['turn']
+        session['routes'].append(route)
+    telemetry = getTelemetry()
+    with telemetry['lock']:
+        telemetry['routes'][(task, model, reason)] = telemetry['routes'].get((task, model, reason), 0) + 1
+    exportRecord(route)
+
+# Function that records the latency of a successful completion request of a model: 'complete' for the whole answer, 'first_output' for the first words of a streamed one.
+def recordLatency(model, metric, seconds):
+    telemetry = getTelemetry()
+    with telemetry['lock']:
+        telemetry['latencies'].setdefault((model, metric), deque(maxlen=latency_window)).append(seconds)
+
+# Function that returns a quantile (e.g. 0.95) of the recent latencies of a model, or None if there are fewer than latency_min_samples of them.
+def getLatencyQuantile(model, metric, share):
+    telemetry = getTelemetry()
+    with telemetry['lock']:
+        samples = sorted(telemetry['latencies'].get((model, metric), ()))
+    if len(samples) < latency_min_samples:
+        return None
+    return samples[min(len(samples) - 1, int(round(share * (len(samples) - 1))))]
+
+# Decorator that records a timing span for every call of the decorated function, named after the function.
+def traced(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            recordSpan(function.__name__, time.perf_counter() - start)
+    return wrapper
+
+# Function that submits a function to one of the background thread pools, handing the telemetry of the current session (and the current turn) over to the thread,
+# so spans recorded there end up in the debug panel of the right session.
+def submitTraced(executor, function, *args):
+    session = getSessionTelemetry()
+    turn = session['turn'] if session is not None else None
+    def run():
+        telemetryContext.session, telemetryContext.turn = session, turn
+        try:
+            return function(*args)
+        finally:
+            telemetryContext.session = telemetryContext.turn = None
+    return executor.submit(run)
+
+# Function that shows the telemetry of the current session in a collapsed panel (in the sidebar, see debugPanel() in main()): the tokens and cost of the recent turns, and the timing spans of the last turn.
+# The background threads of the session keep appending to its spans and routes, so the panel works on copies (list() copies a deque in one go, without running any
+# Python code in between, so no other thread can append in the middle of it).
+def showTelemetryPanel():
+    session = getSessionTelemetry()
+    turns, all_spans, all_routes = list(session['turns']), list(session['spans']), list(session['routes'])
+    with st.expander("Debug: Timings and cost"):
+        if turns:
+            st.caption(f"Session total: {sum(turn['prompt_tokens'] + turn['completion_tokens'] for turn in turns)} tokens, approx. {sum(turn['cost'] for turn in turns):.3f}$")
+            st.dataframe([{key: turn.get(key) for key in ('turn', 'model', 'prompt_tokens', 'completion_tokens', 'image_cost', 'cost')} for turn in turns], hide_index=True)
+        spans = [span for span in all_spans if span['turn'] == session['turn'] and session['turn'] > 0]
+        if spans:
+            st.caption(f"Timings of turn {session['turn']} (seconds)")
+            st.dataframe([{key: span.get(key) for key in ('name', 'duration', 'first_output')} for span in spans], hide_index=True)
+        routes = [route for route in all_routes if route['turn'] == session['turn'] and session['turn'] > 0]
+        if routes:
+            st.caption(f"Models used in turn {session['turn']}")
+            st.dataframe([{key: route.get(key) for key in ('task', 'model', 'reason', 'deadline')} for route in routes], hide_index=True)
+        reruns = [span['duration'] for span in all_spans if span['name'] == 'main']
+        if reruns:
+            st.caption(f"Last rerun: {reruns[-1]:.3f}s, slowest of the last {len(reruns)}: {max(reruns):.3f}s")
+
+# Function that renders the process-wide telemetry in the Prometheus text format.
+def formatMetrics(telemetry):
+    with telemetry['lock']:
+        lines = ["# TYPE storybot_span_seconds summary"]
+        for name, (count, total) in sorted(telemetry['spans'].items()):
+            lines.append(f'storybot_span_seconds_count{{span="{name}"}} {count}')
+            lines.append(f'storybot_span_seconds_sum{{span="{name}"}} {total:.6f}')
+        lines.append("# TYPE storybot_tokens_total counter")
+        for (model, kind), tokens in sorted(telemetry['tokens'].items()):
+            lines.append(f'storybot_tokens_total{{model="{model}",kind="{kind}"}} {tokens}')
+        lines.append("# TYPE storybot_cost_dollars_total counter")
+        for model, cost in sorted(telemetry['cost'].items()):
+            lines.append(f'storybot_cost_dollars_total{{model="{model}"}} {cost:.6f}')
+        lines.append("# TYPE storybot_routes_total counter")
+        for (task, model, reason), count in sorted(telemetry['routes'].items()):
+            lines.append(f'storybot_routes_total{{task="{task}",model="{model}",reason="{reason}"}} {count}')
+        lines.append("# TYPE storybot_model_latency_seconds gauge")
+        for (model, metric), samples in sorted(telemetry['latencies'].items()):
+            ordered = sorted(samples)
+            for share in (0.5, 0.95, 0.99):
+                lines.append(f'storybot_model_latency_seconds{{model="{model}",metric="{metric}",quantile="{share}"}} {ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]:.4f}')
+    return "\n".join(lines) + "\n"
+
+# Function that starts the local metrics endpoint (http://127.0.0.1:<port>/metrics) on a background thread.
+def startMetricsServer(telemetry, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics": # Any other path gets an empty 404
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            data = formatMetrics(telemetry).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args): # Keep the console quiet
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+# Function that returns the process-wide state used for checking API keys: a pooled HTTP session (reusing connections across logins), a random salt
+# for hashing the keys, and the cache of recent check results. Like the other shared resources, it is created once per process.
+@st.cache_resource(show_spinner=False)
+def getKeyCheckService():
+    return {'lock': threading.Lock(), 'session': requests.Session(), 'salt': os.environ.get("STORYBOT_KEY_SALT", "").encode("utf-8") or os.urandom(16), 'results': {}}
+
+# Helper function that returns a salted hash of an API key. The salt is random per process, so the hashes cannot be compared against precomputed hashes of leaked keys.
+# The raw key is never used as a key of any cache or pool. Replicas that share a session store need to share the salt as well (set STORYBOT_KEY_SALT), as the stories
+# in the store are tied to the hash of their owner's key.
+def hashApiKey(api_key):
+    return hmac.new(getKeyCheckService()['salt'], api_key.encode("utf-8"), hashlib.sha256).hexdigest()
+
 # Function to check the validity of the OpenAI API key, rejecting the key if it is not valid in the first place (thus restricting user access to the main part of the program)
+# Instead of the legacy engines listing, a single model is requested, which is a much smaller answer (a 404 means the key is valid, but has no access to that model).
+# Definite answers are cached by the salted hash of the key, so a recently seen key is checked in no time. Timeouts and server errors are never cached.
+@traced
 def check_api_key(api_key):
-    headers = {"Authorization": f"Bearer {api_key}"}
-    url = "https://api.openai.com/v1/engines"
+    service = getKeyCheckService()
+    key_hash = hashApiKey(api_key)
+    with service['lock']:
+        cached = service['results'].get(key_hash)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
 
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return True, "Valid API Key"
+    headers = {"Authorization": f"Bearer {api_key}"}
+    url = f"{openai_base_url}/models/{gpt_model_options[-1]}"
+
+    try:
+        response = service['session'].get(url, headers=headers, timeout=key_check_timeout)
+    except requests.RequestException as e:
+        return False, f"Could not reach OpenAI: {e.__class__.__name__}"
+    if response.status_code in (200, 404):
+        result, ttl = (True, "Valid API Key"), key_check_ttl
     elif response.status_code == 401:
-        return False, "Invalid API Key: Unauthorized"
+        result, ttl = (False, "Invalid API Key: Unauthorized"), key_check_negative_ttl
     else:
         return False, f"Failed with status code: {response.status_code}"
 
+    now = time.monotonic()
+    with service['lock']:
+        if len(service['results']) >= key_check_cache_size: # Make room by dropping expired results, or the oldest ones if none have expired
+            for old_hash in [old_hash for old_hash, (expires, _) in service['results'].items() if expires <= now] or list(service['results'])[:len(service['results']) // 2]:
+                del service['results'][old_hash]
+        service['results'][key_hash] = (now + ttl, result)
+    return result
+
 
 # Helper Function that takes text input from the session_state and uses it to display a toast widget in streamlit. 
 # Unless otherwise specified, a checkbox icon will be provided automatically.
@@ -114,9 +505,330 @@ def display_toast_msg(icon='✅'):
     st.session_state.toast_msg = False
     return
 
+# Function that returns the process-wide pool of API clients. Streamlit reruns the whole script several times per story turn, and building new clients each time
+# means new HTTP connections and TLS handshakes. The pool keeps the clients (and their connections) alive across reruns. It is keyed by a hash of the API key,
+# so clients are only ever handed out to sessions that know the very same key, and the key itself is never stored as a key of the pool.
+@st.cache_resource(show_spinner=False)
+def getClientPool():
+    return {'lock': threading.Lock(), 'clients': {}, 'by_id': {}}
+
+# Helper function that returns the pool key for an API key (and model). The raw key is hashed, so it never shows up in the pool itself.
+def getClientKey(api_key, model=None):
+    return (hashApiKey(api_key), model)
+
+# Helper function that removes a client (and the chains built on it) from the pool. The caller holds the pool lock.
+# The client is not closed: other sessions with the same key (or a request still running) may hold on to it. Its HTTP connections are released once the last
+# reference to it is gone and it is garbage collected.
+def removeClient(pool, key):
+    entry = pool['clients'].pop(key)
+    pool['by_id'].pop(id(entry['client']), None)
+
+# Function that returns the OpenAI client (for images and moderation) and the ChatOpenAI client (for langchain) for the given API key and model, creating them only if
+# they are not in the pool yet. Every call also removes clients that have been idle for longer than client_idle_ttl.
+def getClients(api_key, model):
+    from openai import OpenAI # OpenAI API Interface (imported on first use, see the imports section)
+    from langchain_openai import ChatOpenAI # OpenAI for Langchain Functions
+    pool = getClientPool()
+    now = time.monotonic()
+    with pool['lock']:
+        for key, entry in list(pool['clients'].items()):
+            if now - entry['last_used'] > client_idle_ttl:
+                removeClient(pool, key)
+        clients = []
+        for key, factory in ((getClientKey(api_key), lambda: OpenAI(api_key=api_key, base_url=openai_base_url, max_retries=0)), # Retries are handled by the scheduler
+                             (getClientKey(api_key, model), lambda: ChatOpenAI(model=model, openai_api_key=api_key, openai_api_base=openai_base_url, max_retries=0))):
+            if key not in pool['clients']:
+                pool['clients'][key] = {'client': factory(), 'last_used': now, 'chains': {}}
+                pool['by_id'][id(pool['clients'][key]['client'])] = pool['clients'][key]
+            pool['clients'][key]['last_used'] = now
+            clients.append(pool['clients'][key]['client'])
+    return clients
+
+# Function that removes all pooled clients belonging to an API key from the pool (called on logout).
+def evictClients(api_key):
+    pool = getClientPool()
+    key_hash = getClientKey(api_key)[0]
+    with pool['lock']:
+        for key in [key for key in pool['clients'] if key[0] == key_hash]:
+            removeClient(pool, key)
+
+# Function that imports the heavy packages in a background thread, once per process. The login page starts it, so the packages are usually loaded
+# by the time the parent has typed in their API key, while the login page itself does not have to wait for them.
+@st.cache_resource(show_spinner=False)
+def preloadPackages():
+    def load():
+        import openai, langchain_openai, langchain.prompts, langchain_core.output_parsers, tiktoken
+    thread = threading.Thread(target=load, name="preload", daemon=True)
+    thread.start()
+    return thread
+
+# Function that returns the langchain prompt templates for the conversation stages (ChatPromptTemplate: the system message, the chat history for stage 1 and the user prompt)
+# and the summary (PromptTemplate), built from the definitions in section 03 once per process. The indentation of the instructions is removed, it would only cost tokens.
+@st.cache_resource(show_spinner=False)
+def getPromptTemplates():
+    from langchain.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceholder # Prompt Template Package for custom Prompting
+    stages = []
+    for template in promptTemplates:
+        messages = [("system", textwrap.dedent(template['system']).strip())]
+        if template['history']:
+            messages.append(MessagesPlaceholder("chathistory", optional=True))
+        stages.append(ChatPromptTemplate.from_messages(messages + [("human", "{userprompt}")]))
+    return {'stages': stages, 'summary': PromptTemplate(input_variables=summaryTemplate['input_variables'], template=textwrap.dedent(summaryTemplate['template']).strip())}
+
+# Helper function that returns whether the prompt template of a conversation stage includes the chat history (stage 1) or not (stage 0).
+def usesChatHistory(conversation_stage):
+    return promptTemplates[conversation_stage]['history']
+
+# Function that returns the response_format sent along with the story requests of a conversation stage to a model (see response_formats), or None.
+# With 'json_schema', the answer keys of the stage are all required and no other keys are allowed, so every answer has its suggestions (which may be empty at the end).
+def getResponseFormat(conversation_stage, model):
+    mode = response_formats.get(model, 'json_schema')
+    if mode != 'json_schema':
+        return {'type': mode} if mode else None
+    keys = promptTemplates[conversation_stage]['schema']
+    return {'type': 'json_schema', 'json_schema': {'name': f"story_part_stage_{conversation_stage}", 'strict': True, 'schema': {
+        'type': 'object', 'properties': {key: {'type': kind} for key, kind in keys.items()}, 'required': list(keys), 'additionalProperties': False}}}
+
+# Function that returns the langchain chain for a pooled ChatOpenAI client: the prompt template of a conversation stage (0 or 1) piped into the client (bound to the
+# response_format of the stage, see getResponseFormat()) and a JsonOutputParser(), or for kind 'summary', the summary template piped into the client and a StrOutputParser().
+# Chains are stored with the pooled client, so they are only built once per client instead of on every request. Clients that are not (or no longer) in the pool get a fresh chain.
+def getChain(client, kind):
+    from langchain_core.output_parsers import JsonOutputParser, StrOutputParser # Package for interpreting OpenAI responses as JSON objects (or plain text) for further processing
+    pool = getClientPool()
+    with pool['lock']:
+        entry = pool['by_id'].get(id(client))
+        chains = entry['chains'] if entry is not None and entry['client'] is client else {}
+        if kind not in chains:
+            if kind == 'summary':
+                chains[kind] = getPromptTemplates()['summary'] | client | StrOutputParser()
+            else:
+                response_format = getResponseFormat(kind, client.model_name)
+                model = client.bind(response_format=response_format) if response_format else client
+                chains[kind] = getPromptTemplate(kind) | model | JsonOutputParser()
+        return chains[kind]
+
+# Function that returns the fastest model, together with the reason for the choice: the model with the lowest median latency of its recent story requests ('fastest'),
+# or fast_model ('default') as long as there are too few latencies of it. Models are only compared once there are enough latencies of them.
+# An excluded model (e.g. the one a hedged request was sent to) is never returned; if there is no other model with enough latencies, the result is (None, None).
+def getFastestModel(exclude=None):
+    if fast_model != exclude and getLatencyQuantile(fast_model, 'complete', 0.5) is None:
+        return fast_model, 'default'
+    medians = [(getLatencyQuantile(model, 'complete', 0.5), model) for model in gpt_model_options if model != exclude]
+    medians = [(median, model) for median, model in medians if median is not None]
+    return (min(medians)[1], 'fastest') if medians else (None, None)
+
+# Function that picks the model for a task ('opener', 'story' or 'summary') according to model_routes, given the model selected in the sidebar, and records the decision.
+def routeModel(task, selected_model):
+    if model_routes.get(task) == 'fastest':
+        model, reason = getFastestModel()
+    else:
+        model, reason = selected_model, 'selected'
+    recordRoute(task, model, reason)
+    return model
+
+# Helper function that returns the pooled ChatOpenAI client for another model, with the same API key as the given one.
+def getRoutedClient(client, model):
+    if client.model_name == model:
+        return client
+    return getClients(getClientApiKey(client), model)[1]
+
+# Function that returns the thread pool used for racing hedged requests. Like the other pools, it is created once per process.
+@st.cache_resource(show_spinner=False)
+def getHedgeExecutor():
+    return ThreadPoolExecutor(max_workers=hedge_worker_count, thread_name_prefix="hedge")
+
+# Helper function that returns the hedging deadline (in seconds) for a request to a model, derived from the p95 of its recent latencies (see hedge_factor).
+def getHedgeDeadline(model, metric):
+    p95 = getLatencyQuantile(model, metric, 0.95)
+    return p95 * hedge_factor if p95 is not None else hedge_default_deadline
+
+# Function that runs a request (a function taking the model) for a task with hedging: if the request to the model has not returned by its deadline, the same request is
+# sent to the fastest other model, and the first successful answer wins. Without another model to send it to, the request is simply waited for. An answer that fails (e.g. because it is not valid JSON) only counts once the other request has failed, too.
+# The answer of the request that lost is thrown away (it cannot be called back, but it is not waited for either). Returns the answer and the model that gave it.
+def hedgeRequest(task, request, model):
+    deadline = getHedgeDeadline(model, 'complete')
+    primary = submitTraced(getHedgeExecutor(), request, model)
+    wait([primary], timeout=deadline)
+    backup_model = getFastestModel(exclude=model)[0]
+    if primary.done() or backup_model is None:
+        return primary.result(), model
+    recordRoute(task, backup_model, 'hedge', deadline=round(deadline, 2))
+    pending = {primary: model, submitTraced(getHedgeExecutor(), request, backup_model): backup_model}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            winner = pending.pop(future)
+            if future.exception() is None:
+                for other in pending:
+                    other.cancel()
+                recordRoute(task, winner, 'hedge won' if future is not primary else 'hedge lost')
+                return future.result(), winner
+    return primary.result(), model # Both failed, the error of the original request is raised
+
+# Streaming variant of hedgeRequest(): the stream (a function taking the model and returning an iterator) is read on a thread of its own. If its first item has not
+# arrived by the deadline (derived from the time to the first words), the request (see hedgeRequest()) is sent to the fastest other model. Whichever comes first, the first item
+# of the stream or the whole answer of the backup request, wins. Yields the items of the stream, or the backup answer as the only item, together with the model.
+def hedgeStream(task, stream, request, model):
+    items = queue.Queue()
+    stop = threading.Event()
+    def read():
+        try:
+            for item in stream(model):
+                items.put(('item', item))
+                if stop.is_set():
+                    return # Closing the stream discards the rest of the answer
+            items.put(('done', None))
+        except Exception as e:
+            items.put(('error', e))
+    submitTraced(getHedgeExecutor(), read)
+    deadline = getHedgeDeadline(model, 'first_output')
+    backup = None
+    try:
+        backup_model = getFastestModel(exclude=model)[0]
+        try:
+            kind, value = items.get(timeout=deadline if backup_model is not None else None)
+        except queue.Empty:
+            recordRoute(task, backup_model, 'hedge', deadline=round(deadline, 2))
+            backup = submitTraced(getHedgeExecutor(), request, backup_model)
+            while True:
+                try:
+                    kind, value = items.get(timeout=0.05)
+                    break
+                except queue.Empty:
+                    if backup.done() and backup.exception() is None:
+                        recordRoute(task, backup_model, 'hedge won')
+                        yield backup.result(), backup_model
+                        return
+            backup.cancel()
+            recordRoute(task, model, 'hedge lost')
+        while kind == 'item':
+            yield value, model
+            kind, value = items.get()
+        if kind == 'error':
+            if backup is not None and not backup.cancelled() and backup.exception() is None: # The stream failed, but the backup came through
+                yield backup.result(), backup_model
+                return
+            raise value
+    finally:
+        stop.set()
+
+# Function that returns the process-wide request scheduler, which holds the rate limit state of every API key (token buckets and a concurrency limit).
+@st.cache_resource(show_spinner=False)
+def getScheduler():
+    return {'lock': threading.Lock(), 'keys': {}}
+
+# Helper function that returns the rate limit state of an API key, creating it on first use. For every kind of request there is a bucket for requests and one for tokens,
+# each refilling continuously up to one minute's worth of its limit.
+def getKeyLimits(scheduler, key_hash):
+    with scheduler['lock']:
+        if key_hash not in scheduler['keys']:
+            buckets = {}
+            for kind, limits in rate_limits.items():
+                for unit, per_minute in zip(('requests', 'tokens'), limits):
+                    if per_minute:
+                        buckets[(kind, unit)] = {'capacity': per_minute, 'level': per_minute, 'rate': per_minute / 60, 'updated': time.monotonic()}
+            scheduler['keys'][key_hash] = {'buckets': buckets, 'blocked_until': 0, 'slots': threading.BoundedSemaphore(max_concurrent_requests)}
+        return scheduler['keys'][key_hash]
+
+# Function that waits until the rate limits of an API key allow another request of the given kind (costing the given number of tokens), then takes it out of the buckets.
+def acquireRateLimit(key_hash, kind, tokens=0):
+    scheduler = getScheduler()
+    limits = getKeyLimits(scheduler, key_hash)
+    while True:
+        with scheduler['lock']:
+            now = time.monotonic()
+            wait = limits['blocked_until'] - now # After a 429, all requests of the key wait for the time the API asked for
+            needed = []
+            for unit, amount in (('requests', 1), ('tokens', tokens)):
+                bucket = limits['buckets'].get((kind, unit))
+                if bucket is None or not amount:
+                    continue
+                bucket['level'] = min(bucket['capacity'], bucket['level'] + (now - bucket['updated']) * bucket['rate'])
+                bucket['updated'] = now
+                amount = min(amount, bucket['capacity']) # A single huge request must not wait forever
+                needed.append((bucket, amount))
+                wait = max(wait, (amount - bucket['level']) / bucket['rate'])
+            if wait <= 0:
+                for bucket, amount in needed:
+                    bucket['level'] -= amount
+                return limits
+        time.sleep(min(wait, 1.0))
+
+# Helper function that returns the API key of a (pooled) OpenAI or ChatOpenAI client, so requests can be scheduled per key.
+def getClientApiKey(client):
+    api_key = getattr(client, 'openai_api_key', None) or getattr(client, 'api_key', None) or ""
+    return api_key.get_secret_value() if hasattr(api_key, 'get_secret_value') else api_key
+
+# Function that returns how long to wait before retrying a failed request, or None if the error is not worth retrying. Rate limit errors (429), server errors (5xx),
+# timeouts and connection errors are retried, using the Retry-After header of the API if there is one, and jittered exponential backoff otherwise.
+def getRetryDelay(error, attempt):
+    import openai # OpenAI API errors
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code != 429 and error.status_code < 500:
+            return None
+        headers = error.response.headers
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            try:
+                return float(headers["retry-after"])
+            except ValueError:
+                return max(0.0, email.utils.parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time())
+    elif not isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return None
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt)) # 'Full jitter', so retries of many sessions do not line up
+
+# Function that runs a request to the OpenAI API (given as a function without arguments) through the scheduler: it waits for the rate limits of the client's API key,
+# keeps to the concurrency limit of the key and retries rate limit and transient errors. A 429 also pauses all other requests of the same key.
+def scheduleCall(client, kind, request, tokens=0):
+    key_hash = hashApiKey(getClientApiKey(client))
+    for attempt in range(max_retries + 1):
+        limits = acquireRateLimit(key_hash, kind, tokens)
+        with limits['slots']:
+            try:
+                return request()
+            except Exception as e:
+                delay = getRetryDelay(e, attempt)
+                if delay is None or attempt == max_retries:
+                    raise
+                rate_limited = getattr(e, 'status_code', None) == 429
+        if rate_limited:
+            with getScheduler()['lock']:
+                limits['blocked_until'] = max(limits['blocked_until'], time.monotonic() + delay)
+        recordSpan("retry", delay, kind=kind, attempt=attempt + 1)
+        time.sleep(delay)
+
+# Streaming variant of scheduleCall(): the request is a function returning an iterator, whose items are passed on. The request can only be retried until
+# the first item has arrived, afterwards errors are raised as they are. The concurrency slot is only held while the stream is opened (up to its first item):
+# the caller may wait for other requests of the same key between two items (e.g. the input moderation), which must not be kept from getting a slot.
+def scheduleStream(client, kind, request, tokens=0):
+    key_hash = hashApiKey(getClientApiKey(client))
+    end = object()
+    for attempt in range(max_retries + 1):
+        limits = acquireRateLimit(key_hash, kind, tokens)
+        with limits['slots']:
+            try:
+                items = iter(request())
+                first = next(items, end)
+                break
+            except Exception as e:
+                delay = getRetryDelay(e, attempt)
+                if delay is None or attempt == max_retries:
+                    raise
+                rate_limited = getattr(e, 'status_code', None) == 429
+        if rate_limited:
+            with getScheduler()['lock']:
+                limits['blocked_until'] = max(limits['blocked_until'], time.monotonic() + delay)
+        recordSpan("retry", delay, kind=kind, attempt=attempt + 1)
+        time.sleep(delay)
+    if first is end:
+        return
+    yield first
+    yield from items
+
 # Helper function that returns the correct prompt template based on the conversation stage (0 or 1)
 def getPromptTemplate(conversation_stage):
-    return promptTemplates[conversation_stage]
+    return getPromptTemplates()['stages'][conversation_stage]
 
 # Helper function that returns the correct chat input placeholder text based on the conversation stage (depending on what the user should do, they get different call-to-actions)
 def getChatInputPrompt():
@@ -128,76 +840,672 @@ def getChatInputPrompt():
 
 
 # Function that looks for previous interactions between user and assistant, and creates a pre-styled chat message object for each interaction.
-def showChatHistory():
+# With start, only the messages from that position on are shown (the chat window appends new messages to the ones shown on the last full rerun, see main()).
+def showChatHistory(start=0):
     if 'chat_history' in st.session_state:
-        for msg in st.session_state.chat_history:
+        for msg in st.session_state.chat_history[start:]:
                 with st.chat_message(msg["role"]):
                     st.markdown(msg["content"])
 
 # Function that consults OpenAI's moderation interface to check the user input for possible policy violations. If flagged for any violations, the function will return True.
+# The prompt can also be a list of texts (e.g. the story and the dall-e prompt of a response), in which case the function returns True if any of them is flagged.
+@traced
 def checkContentViolation(client, prompt):
-    response = client.moderations.create(input=prompt)
-    return response.results[0].flagged
-
-# Function that adds the latest user prompt to the chat history, persisting it in the session_state. In the runtime of the program, function calls for adding user messages are
-# always preceded by checkContentViolation(). Content violations concerning the assistant output are caught elsewhere.
+    response = scheduleCall(client, 'moderation', lambda: client.moderations.create(input=prompt))
+    return any(result.flagged for result in response.results)
+
+# Function that returns the thread pool used for running moderation requests in the background, next to the completion request. Like the image pool,
+# it is created once per process and shared by all sessions. It is kept separate from the image pool, so moderation never waits behind slow image jobs.
+@st.cache_resource(show_spinner=False)
+def getModerationExecutor():
+    return ThreadPoolExecutor(max_workers=moderation_worker_count, thread_name_prefix="moderation")
+
+# Function that starts a moderation request in the background and returns a future, whose result() is True if the content was flagged.
+def startModeration(client, prompt):
+    return submitTraced(getModerationExecutor(), checkContentViolation, client, prompt)
+
+# Function that returns the connection to the local response cache, creating the database on first use. Like the client pool, the connection is shared by the whole process,
+# and since it is also used from the image threads, all access goes through the lock.
+@st.cache_resource(show_spinner=False)
+def getResponseCache():
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    db = sqlite3.connect(cache_path, check_same_thread=False)
+    db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL, expires REAL)")
+    return {'lock': threading.Lock(), 'db': db}
+
+# Helper function that turns the parts identifying a cached response (e.g. model, stage, history and prompt) into a content-addressed cache key.
+def getCacheKey(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Function that looks up a response in the local cache and returns it (or None). Every lookup is counted as a hit or miss in the session_state.
+def cacheGet(key):
+    cache = getResponseCache()
+    now = time.time()
+    with cache['lock']:
+        row = cache['db'].execute("SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, now)).fetchone()
+        if row is not None:
+            cache['db'].execute("UPDATE cache SET last_used = ? WHERE key = ?", (now, key))
+            cache['db'].commit()
+    stats = st.session_state.setdefault('cache_stats', {'hits': 0, 'misses': 0})
+    stats['hits' if row is not None else 'misses'] += 1
+    return json.loads(row[0]) if row is not None else None
+
+# Function that stores a response in the local cache, then evicts the least recently used entries until the cache is below cache_max_bytes again.
+def cachePut(key, value, ttl=None):
+    cache = getResponseCache()
+    data = json.dumps(value)
+    now = time.time()
+    with cache['lock']:
+        db = cache['db']
+        db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)", (key, data, len(data), now, now + ttl if ttl else None))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        for old_key, size in db.execute("SELECT key, size FROM cache ORDER BY last_used").fetchall():
+            if total <= cache_max_bytes:
+                break
+            db.execute("DELETE FROM cache WHERE key = ?", (old_key,))
+            total -= size
+        db.commit()
+
+# Function that returns the cache key of a story completion, which depends on the model, the conversation stage, the (trimmed) chat history and the user prompt.
+def getCompletionCacheKey(chat_history, user_prompt):
+    return getCacheKey("completion", st.session_state.gpt_model, st.session_state.conv_stage, chat_history, user_prompt)
+
+# Function that looks up a cached story completion and returns the answer together with the model that wrote it (which is not necessarily the selected model,
+# see routeModel() and hedgeRequest()), or None. Entries from before the model was stored with the answer are ignored.
+def getCachedCompletion(cache_key):
+    cached = cacheGet(cache_key)
+    if cached is None or 'model' not in cached:
+        return None
+    return cached['output'], cached['model']
+
+# Function that stores a story completion in the cache, together with the model that wrote it.
+def cacheCompletion(cache_key, output, model):
+    cachePut(cache_key, {'output': output, 'model': model})
+
+# Function that adds the latest user prompt to the chat history, persisting it in the session_state. In the runtime of the program, messages are only added
+# once checkContentViolation() has cleared them, both for the user input and for the assistant output (see submitPrompt()).
+# The new message is tokenized right away and its token count is stored in the token ledger, so it never has to be tokenized again when the prompt is trimmed.
 def addMessage(role, content):
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
     st.session_state.chat_history.append({'role': role, 'content': content})
-
-# Function that consults the completion interface of the selected OpenAI model. This is done by invoking a custom langchain, which modifies the original prompt with a
-# PromptTemplate and uses a JSONOutputParser() to interpret the JSON-styled output of the LLM, returning the parsed output.
+    if 'gpt_model' in st.session_state:
+        getTokenLedger()
+
+# Helper function that returns the suggestions of a stage-1 answer, i.e. its non-empty 'opt' values, or none at all if the answer is the end of the story ('end' is set).
+# Models without structured output sometimes leave out the 'end' key (or the 'opt' keys), so an answer without any suggestions counts as the end of the story, too.
+def getStoryOptions(response):
+    if response.get("end") is True:
+        return []
+    return [response[f"opt{i}"].strip() for i in range(1, 4) if isinstance(response.get(f"opt{i}"), str) and response[f"opt{i}"].strip()]
+
+# Helper function that returns the routing task of a story request: the opener of a story (stage 0) or a further story part (stage 1).
+def getStoryTask(conversation_stage):
+    return 'opener' if conversation_stage == 0 else 'story'
+
+# Function that runs the chain of the given conversation stage with a model, through the scheduler, and records the latency of the answer (see getFastestModel()).
+def requestStoryPart(client, model, conversation_stage, chat_history, user_prompt, tokens):
+    client = getRoutedClient(client, model)
+    chain = getChain(client, conversation_stage)
+    def request():
+        start = time.perf_counter()
+        output = chain.invoke({"chathistory": chat_history, "userprompt": user_prompt})
+        recordLatency(model, 'complete', time.perf_counter() - start)
+        return output
+    return scheduleCall(client, 'completion', request, tokens=tokens)
+
+# Function that writes the next story part: it runs the chain of the given conversation stage on the (already trimmed) chat history and the user prompt, with the model
+# picked by routeModel() (the client is the one of the model selected in the sidebar), hedged if asked to. Returns the answer and the model that wrote it.
+# It does not depend on the session, so it is also used for prefetching and by the batch generation (see storybot_batch.py).
+def writeStoryPart(client, conversation_stage, chat_history, user_prompt, tokens, hedge=False):
+    task = getStoryTask(conversation_stage)
+    model = routeModel(task, client.model_name)
+    request = lambda model: requestStoryPart(client, model, conversation_stage, chat_history, user_prompt, tokens)
+    if hedge:
+        return hedgeRequest(task, request, model)
+    return request(model), model
+
+# Function that consults the completion interface of the selected OpenAI model (or the model the request is routed to, see routeModel()). This is done by invoking a custom
+# langchain, which turns the original prompt into chat messages with a ChatPromptTemplate and uses a JSONOutputParser() to interpret the JSON-styled output of the LLM, returning the parsed output.
+# The user prompt is not part of the chat_history yet (it is still being moderated), it is sent as the last message of the prompt (see promptTemplates).
+# The model that wrote the answer is kept in the session_state (response_model), for the cost estimate of the turn, and whether it came from the cache (response_cached).
+@traced
 def getBotResponse(client,user_prompt):
-        prompt = getPromptTemplate(st.session_state.conv_stage)
         chat_history = reduceChatHistoryLength(user_prompt)
         
-        chain = prompt | client | JsonOutputParser()
-        # NOTE: I intentionally decided not to use a stream here. It does not make too much sense streaming an (incomplete) JSON object. Since the story pieces are not
-        # too long and the user is notified of the "thinking" with a spinner, this does not impair the user experience too much in my opinion.
-        output = chain.invoke({
-            "chathistory": chat_history,
-            "userprompt": user_prompt
-        })
+        # If the response cache is turned on and the very same request has been answered before, the cached answer is returned instead.
+        cache_key = getCompletionCacheKey(chat_history, user_prompt)
+        if st.session_state.use_cache:
+            cached = getCachedCompletion(cache_key)
+            if cached is not None:
+                output, st.session_state.response_model = cached
+                st.session_state.response_cached = True
+                return output
+
+        # NOTE: This is the blocking variant, used when streaming is turned off in the sidebar. See streamBotResponse() for the streaming variant.
+        st.session_state.response_cached = False
+        output, st.session_state.response_model = writeStoryPart(client, st.session_state.conv_stage, chat_history, user_prompt,
+                                                                 st.session_state.prompt_token_len + completion_token_estimate, hedge=st.session_state.hedge_requests)
+        if st.session_state.use_cache:
+            cacheCompletion(cache_key, output, st.session_state.response_model)
         return output
 
+# Streaming variant of getBotResponse(). Instead of waiting for the whole JSON object, the chain is streamed and the JsonOutputParser() parses the incomplete JSON
+# on the fly, so this generator yields an increasingly complete dict (the 'story' value grows token by token) together with the set of keys whose values are final.
+# A value is final as soon as the model has moved on to the next key (the JSON keys arrive in order), and all values are final once the stream has ended.
+# The timing span of the stream also records the time to the first partial answer, which is the wait the user actually notices.
+def streamBotResponse(client,user_prompt):
+        start = time.perf_counter()
+        first_output = None
+        try:
+            chat_history = reduceChatHistoryLength(user_prompt)
+
+            # A cached answer is yielded in one go, with all of its values being final.
+            cache_key = getCompletionCacheKey(chat_history, user_prompt)
+            if st.session_state.use_cache:
+                cached = getCachedCompletion(cache_key)
+                if cached is not None:
+                    output, st.session_state.response_model = cached
+                    st.session_state.response_cached = True
+                    first_output = time.perf_counter() - start
+                    yield output, set(output.keys())
+                    return
+
+            # The stream of a model, which records the latency of its first words and of the whole answer (see getFastestModel()). If hedging is turned on, the
+            # stream is raced against a blocking backup request (see hedgeStream()), whose answer arrives in one go, with all of its values being final.
+            stage = st.session_state.conv_stage
+            tokens = st.session_state.prompt_token_len + completion_token_estimate
+            def stream(model):
+                model_client = getRoutedClient(client, model)
+                chain = getChain(model_client, stage)
+                def request():
+                    stream_start = time.perf_counter()
+                    first = True
+                    for output in chain.stream({"chathistory": chat_history, "userprompt": user_prompt}):
+                        if first and isinstance(output, dict):
+                            recordLatency(model, 'first_output', time.perf_counter() - stream_start)
+                            first = False
+                        yield output
+                    recordLatency(model, 'complete', time.perf_counter() - stream_start)
+                return scheduleStream(model_client, 'completion', request, tokens=tokens)
+            task = getStoryTask(stage)
+            model = st.session_state.response_model = routeModel(task, client.model_name)
+            st.session_state.response_cached = False
+            if st.session_state.hedge_requests:
+                items = hedgeStream(task, stream, lambda model: requestStoryPart(client, model, stage, chat_history, user_prompt, tokens), model)
+            else:
+                items = ((output, model) for output in stream(model))
+            output = {}
+            for output, model in items:
+                st.session_state.response_model = model
+                if isinstance(output, dict):
+                    if first_output is None:
+                        first_output = time.perf_counter() - start
+                    yield output, set(list(output.keys())[:-1])
+            if st.session_state.use_cache and isinstance(output, dict):
+                cacheCompletion(cache_key, output, model)
+            yield output, set(output.keys()) if isinstance(output, dict) else set()
+        finally:
+            recordSpan("streamBotResponse", time.perf_counter() - start, first_output=first_output and round(first_output, 4))
+
 
 # Similar to showChatHistory(), this is a function that looks for previously generated story images, and creates a streamlit image widget for each image url persisted in the session_state.
-def showImages():
+# The images are shown as their locally stored thumbnails, so the browser does not have to fetch every full-size picture again on each rerun. The thumbnails are
+# passed on as PNG (the format they are stored in), otherwise streamlit would decode and re-encode every one of them as JPEG on every rerun.
+# With start (and end), only the images from that position on (and before end) are shown (like showChatHistory()).
+def showImages(start=0, end=None):
     if 'image_urls' in st.session_state:
-        for image in st.session_state.image_urls:
-                st.image(image["url"], caption=image["caption"], use_column_width=True)
+        for image in st.session_state.image_urls[start:end]:
+            if os.path.exists(image["thumb"]):
+                st.image(image["thumb"], caption=image["caption"], width="stretch", output_format="PNG")
+            else: # The picture has been deleted from the image store in the meantime (see touchImage())
+                st.caption(f"🖼️ {image['caption']} (this picture is no longer available)")
 
 
-# Similar to addMessage(), this is a function that adds the latest image url to the image_urls variable, persisting it in the session_state.
-def addImage(url, caption):
+# Similar to addMessage(), this is a function that adds the latest image to the image_urls variable, persisting it in the session_state.
+# The image is a dict holding the local paths of the full-size picture ('url') and its thumbnail ('thumb'), as returned by storeImage().
+# A preview (progressive pictures) is marked as such until its full-quality picture replaces it (see collectImageJobs()).
+def addImage(image, caption, preview=False):
     if 'image_urls' not in st.session_state:
         st.session_state.image_urls = []
-    st.session_state.image_urls.append({'url': url, 'caption': caption})
-
-
-# Function that consults the OpenAI images interface of the selected OpenAI (DALL-E) model. The image size is fixed at 1024x1024, being the smallest common image size for DALL-E Versions 2 and 3.
-# Note that only the image url is returned, not the actual image object.
-def generateImage(client, prompt):
-    response = client.images.generate(
-        model=st.session_state.dalle_model,
+    st.session_state.image_urls.append({'url': image['url'], 'thumb': image['thumb'], 'caption': caption, **({'preview': True} if preview else {})})
+
+# Helper function that returns the number of pictures at the start of the story that are final, i.e. up to the first preview that is still waiting for its upgrade.
+# Only these are shown on a full rerun, the rest is shown (and replaced once upgraded) by the picture window fragment.
+def countFinalImages():
+    image_urls = st.session_state.get('image_urls') or []
+    return next((i for i, image in enumerate(image_urls) if image.get('preview')), len(image_urls))
+
+
+# Function that writes the bytes of a generated image to the local image store, together with a downscaled thumbnail, and returns the paths of both.
+# The files are named after the hash of the image, so storing the same picture twice does not take up any additional space.
+def storeImage(image_bytes):
+    os.makedirs(image_store_path, exist_ok=True)
+    name = hashlib.sha256(image_bytes).hexdigest()
+    path = os.path.join(image_store_path, f"{name}.png")
+    thumb_path = os.path.join(image_store_path, f"{name}_thumb.png")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(image_bytes)
+    if not os.path.exists(thumb_path):
+        thumbnail = Image.open(io.BytesIO(image_bytes))
+        thumbnail.thumbnail((thumbnail_size, thumbnail_size))
+        thumbnail.save(thumb_path, format="PNG")
+    touchImage(name)
+    return {'url': path, 'thumb': thumb_path}
+
+# Function that returns the process-wide index of the image store: the size of every picture (full size and thumbnail together) by name, least recently stored first.
+# It is built from the files (and their modification times) on first use, so pictures stored before a restart are counted, too. All access goes through the lock.
+@st.cache_resource(show_spinner=False)
+def getImageStore():
+    os.makedirs(image_store_path, exist_ok=True)
+    files = {}
+    for entry in os.scandir(image_store_path):
+        if entry.name.endswith(".png"):
+            name = entry.name.removesuffix(".png").removesuffix("_thumb")
+            size, mtime = files.get(name, (0, 0))
+            files[name] = (size + entry.stat().st_size, max(mtime, entry.stat().st_mtime))
+    images = OrderedDict((name, size) for name, (size, _) in sorted(files.items(), key=lambda item: item[1][1]))
+    return {'lock': threading.Lock(), 'images': images, 'total': sum(images.values())}
+
+# Function that marks a stored picture as the most recently used one (it was just stored, or taken from the response cache), then deletes the least recently used
+# pictures until the image store is below image_store_max_bytes again. Pictures of stories that were reset or have expired are never used again, so they go first.
+# Stories that still show a deleted picture skip it (see showImages()), and cached pictures are only used if their files still exist (see startImageJob()).
+def touchImage(name):
+    store = getImageStore()
+    paths = [os.path.join(image_store_path, f"{name}{suffix}.png") for suffix in ("", "_thumb")]
+    with store['lock']:
+        if name not in store['images']:
+            size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+            store['images'][name] = size
+            store['total'] += size
+        store['images'].move_to_end(name)
+        for path in paths:
+            if os.path.exists(path):
+                os.utime(path) # Keeps the order across restarts
+        while store['total'] > image_store_max_bytes and len(store['images']) > 1:
+            old_name, size = store['images'].popitem(last=False)
+            store['total'] -= size
+            for suffix in ("", "_thumb"):
+                try:
+                    os.remove(os.path.join(image_store_path, f"{old_name}{suffix}.png"))
+                except FileNotFoundError:
+                    pass
+
+
+# Helper function that returns the tier (model, size, quality) full-quality pictures of a DALL-E model are painted with, see image_tiers.
+def getImageTier(model):
+    return image_tiers.get(model, (model, '1024x1024', 'standard'))
+
+# Function that consults the OpenAI images interface of the selected OpenAI (DALL-E) model. Size and quality are those of the model's tier (see image_tiers), unless given.
+# The image is requested as base64 data and written to the local image store right away (see storeImage()), so it does not depend on the expiring DALL-E url.
+# Since the function runs on a background thread (see startImageJob()), where the session_state is not accessible, the model has to be passed in explicitly.
+@traced
+def generateImage(client, prompt, model, size=None, quality=None):
+    _, tier_size, tier_quality = getImageTier(model)
+    response = scheduleCall(client, 'image', lambda: client.images.generate(
+        model=model,
         prompt=prompt,
-        size="1024x1024",
-        quality="standard",
+        size=size or tier_size,
+        quality=quality or tier_quality,
+        response_format="b64_json",
         n=1,
-        )
-    
-    return response.data[0].url
-
+        ))
+
+    if response.data[0].b64_json:
+        image_bytes = base64.b64decode(response.data[0].b64_json)
+    else: # In case the API only returned an url after all, the image is downloaded once
+        download = requests.get(response.data[0].url, timeout=60)
+        download.raise_for_status()
+        image_bytes = download.content
+    return storeImage(image_bytes)
+
+# Function that paints the first picture of a story part (the preview, or the full-quality picture if pictures are not progressive) and records the time from
+# starting the image job to the stored picture as the 'first_picture' span, together with the tier ('preview' or 'full').
+def generateFirstImage(client, prompt, tier, kind, started):
+    model, size, quality = tier
+    image = generateImage(client, prompt, model, size, quality)
+    recordSpan("first_picture", time.perf_counter() - started, tier=kind)
+    return image
+
+# Function that returns the thread pool used for generating images in the background. The pool is created once per process (st.cache_resource) and shared by all sessions,
+# every session only keeps track of its own jobs in its session_state.
+@st.cache_resource(show_spinner=False)
+def getImageExecutor():
+    return ThreadPoolExecutor(max_workers=image_worker_count, thread_name_prefix="dalle")
+
+# Function that starts generating an image in the background and returns the job right away. The running job is persisted in the session_state (image_jobs), so the user can
+# continue reading and writing the story while the picture is being painted. The jobs are picked up again by collectImageJobs() in the picture window.
+# With progressive pictures, the preview and the full-quality picture are painted at the same time: the job finishes with the preview, and the full-quality picture
+# is kept as its 'upgrade', which replaces the preview once it is done.
+# If the response cache is turned on, a cached image is returned as an already finished job, and newly generated images are added to the cache once they are done.
+def startImageJob(client, prompt):
+    if 'image_jobs' not in st.session_state:
+        st.session_state.image_jobs = []
+    started = time.perf_counter()
+    tier = getImageTier(st.session_state.dalle_model)
+    cache_key = getCacheKey("image-file", *tier, prompt)
+    cached_image = cacheGet(cache_key) if st.session_state.use_cache else None
+    if cached_image is not None and os.path.exists(cached_image['url']) and os.path.exists(cached_image['thumb']): # The image files might have been cleaned up in the meantime
+        touchImage(os.path.basename(cached_image['url']).removesuffix(".png"))
+        future = Future()
+        future.set_result(cached_image)
+        return addImageJob(future, prompt, cached=True)
+    if st.session_state.progressive_images:
+        preview = submitTraced(getImageExecutor(), generateFirstImage, client, prompt, image_preview_tier, 'preview', started)
+        future = submitTraced(getImageExecutor(), generateImage, client, prompt, *tier)
+    else:
+        preview = None
+        future = submitTraced(getImageExecutor(), generateFirstImage, client, prompt, tier, 'full', started)
+    if st.session_state.use_cache:
+        future.add_done_callback(lambda f: cacheImage(cache_key, f))
+    if preview is not None:
+        return addImageJob(preview, prompt, upgrade=future)
+    return addImageJob(future, prompt)
+
+# Helper function that adds an image job (a future resolving to a stored image, and optionally the future of the full-quality picture replacing it) to the background
+# image jobs of the session. Pictures taken from the response cache are marked as cached, they cost nothing.
+def addImageJob(future, caption, upgrade=None, cached=False):
+    if 'image_jobs' not in st.session_state:
+        st.session_state.image_jobs = []
+    job = {'future': future, 'caption': caption, 'discarded': False, 'upgrade': upgrade, 'cached': cached}
+    st.session_state.image_jobs.append(job)
+    return job
+
+# Helper function that adds a finished image job to the response cache (called on the image thread once the job is done). Failed or cancelled jobs are not cached.
+def cacheImage(cache_key, future):
+    if not future.cancelled() and future.exception() is None:
+        cachePut(cache_key, future.result())
+
+# Function that throws away a single background image job, e.g. because the story part it belongs to was flagged by the moderation. If the job has not started yet,
+# it is cancelled, otherwise its result is simply ignored by collectImageJobs().
+def discardImageJob(job):
+    job['discarded'] = True
+    job['future'].cancel()
+    if job['upgrade'] is not None:
+        job['upgrade'].cancel()
+
+# Function that moves all finished background image jobs to the image_urls in the session_state. Jobs are collected in the order they were started, so the pictures
+# always appear in the order of the story, even if a later picture happens to be done first. Failed jobs are dropped and their errors are returned for display.
+# Previews (progressive pictures) are added right away, and their upgrades are kept in image_upgrades together with the position of the preview. Finished upgrades
+# replace their preview in place, in whatever order they finish. If an upgrade fails, the preview simply stays. If a preview fails, its upgrade takes its place as
+# a regular job, so an error is only returned if both of them fail.
+def collectImageJobs():
+    errors = []
+    collected = False
+    jobs = st.session_state.get('image_jobs', [])
+    upgrades = st.session_state.setdefault('image_upgrades', [])
+    while jobs and jobs[0]['future'].done():
+        job = jobs.pop(0)
+        if job['discarded'] or job['future'].cancelled():
+            continue
+        if job['future'].exception() is not None and job['upgrade'] is not None:
+            jobs.insert(0, {**job, 'future': job['upgrade'], 'upgrade': None})
+        elif job['future'].exception() is not None:
+            errors.append(job['future'].exception())
+        else:
+            addImage(job['future'].result(), job['caption'], preview=job['upgrade'] is not None)
+            if job['upgrade'] is not None:
+                upgrades.append({'future': job['upgrade'], 'index': len(st.session_state.image_urls) - 1})
+            collected = True
+    for upgrade in [upgrade for upgrade in upgrades if upgrade['future'].done()]:
+        upgrades.remove(upgrade)
+        image = st.session_state.image_urls[upgrade['index']]
+        image.pop('preview', None)
+        if not upgrade['future'].cancelled() and upgrade['future'].exception() is None:
+            image.update(url=upgrade['future'].result()['url'], thumb=upgrade['future'].result()['thumb'])
+        collected = True
+    if collected:
+        saveStory()
+    return errors
+
+# Function that cancels all background image jobs (and upgrades) of the current session that have not started yet (e.g. on reset or logout). Running jobs cannot
+# be interrupted, but their results are discarded since they are no longer referenced anywhere.
+def cancelImageJobs():
+    for job in st.session_state.get('image_jobs', []):
+        job['future'].cancel()
+        if job['upgrade'] is not None:
+            job['upgrade'].cancel()
+    for upgrade in st.session_state.get('image_upgrades', []):
+        upgrade['future'].cancel()
+    st.session_state.image_jobs = []
+    st.session_state.image_upgrades = []
+
+
+# Function that returns the thread pool used for prefetching the continuations of the suggestion buttons. Like the other pools, it is created once per process.
+@st.cache_resource(show_spinner=False)
+def getPrefetchExecutor():
+    return ThreadPoolExecutor(max_workers=prefetch_worker_count, thread_name_prefix="prefetch")
+
+# Function that generates the continuation for one suggestion button (and optionally its picture). It runs on the prefetch thread, so the chain inputs, which depend on the
+# session_state, are prepared up front by startPrefetch(). Prefetches are not hedged, nobody is waiting for them yet. Returns the response, the image and the model used.
+@traced
+def prefetchResponse(client, dalle_client, conversation_stage, chat_history, user_prompt, tokens, dalle_model):
+    response, model = writeStoryPart(client, conversation_stage, chat_history, user_prompt, tokens)
+    image = generateImage(dalle_client, response["dalle-prompt"], dalle_model) if dalle_model else None
+    return response, image, model
+
+# Helper function that returns the prefetch state of the session: the running prefetches per suggestion, and the statistics shown in the sidebar.
+def getPrefetchState():
+    if not st.session_state.get('prefetch'):
+        st.session_state.prefetch = {'entries': {}, 'stats': {'spent': 0, 'hits': 0, 'misses': 0, 'wasted': 0}}
+    return st.session_state.prefetch
+
+# Function that starts prefetching the continuations of all current suggestion buttons, as long as the session's prefetch budget allows it.
+# Each prefetch remembers the state of the chat it was made for, so it is only used if the chat has not changed in the meantime.
+def startPrefetch(client, dalle_client):
+    state = getPrefetchState()
+    prompt_token_len = st.session_state.prompt_token_len # Trimming the history for the prefetches must not change the debug info of the actual turn
+    for option in st.session_state.prompt_buttons:
+        chat_history = reduceChatHistoryLength(option)
+        tokens = st.session_state.prompt_token_len + completion_token_estimate
+        if state['stats']['spent'] + tokens > prefetch_token_budget:
+            break
+        state['stats']['spent'] += tokens
+        future = submitTraced(getPrefetchExecutor(), prefetchResponse, client, dalle_client, st.session_state.conv_stage,
+                              chat_history, option, tokens, st.session_state.dalle_model if prefetch_images else None)
+        state['entries'][option] = {'future': future, 'tokens': tokens, 'prompt_tokens': st.session_state.prompt_token_len, 'model': st.session_state.gpt_model,
+                                    'stage': st.session_state.conv_stage, 'history_len': len(st.session_state.chat_history)}
+    st.session_state.prompt_token_len = prompt_token_len
+
+# Function that cancels all running prefetches of the session. Prefetches that had already started are counted as wasted tokens.
+def cancelPrefetch():
+    state = getPrefetchState()
+    for entry in state['entries'].values():
+        if not entry['future'].cancel():
+            state['stats']['wasted'] += entry['tokens']
+        else:
+            state['stats']['spent'] -= entry['tokens'] # Never sent, so nothing was spent
+    state['entries'] = {}
+
+# Function that returns the prefetched (response, image) for a prompt, waiting for it if it is still being generated, or None if there is no usable prefetch.
+# All other branches are cancelled, since the story has taken a different turn now.
+def takePrefetch(prompt):
+    state = getPrefetchState()
+    if not state['entries']:
+        return None
+    entry = state['entries'].pop(prompt, None)
+    cancelPrefetch()
+    if entry is None or entry['model'] != st.session_state.gpt_model or entry['stage'] != st.session_state.conv_stage or entry['history_len'] != len(st.session_state.chat_history):
+        state['stats']['misses'] += 1
+        if entry is not None and not entry['future'].cancel():
+            state['stats']['wasted'] += entry['tokens']
+        return None
+    try:
+        result = entry['future'].result()
+    except Exception: # If prefetching failed, the response is simply generated the regular way
+        state['stats']['misses'] += 1
+        return None
+    state['stats']['hits'] += 1
+    st.session_state.prompt_token_len = entry['prompt_tokens']
+    response, image, st.session_state.response_model = result
+    st.session_state.response_cached = False # Prefetched continuations have been paid for like any other
+    return response, image
+
+# Function that returns the process-wide session store (see session_store), opening its database on first use. All access goes through the lock.
+@st.cache_resource(show_spinner=False)
+def getSessionStore():
+    os.makedirs(os.path.dirname(session_store_path), exist_ok=True)
+    store = {'lock': threading.Lock(), 'kind': session_store, 'memory': OrderedDict()}
+    if session_store == 'kv':
+        store['kv'] = dbm.open(session_store_path + ".kv", 'c')
+    else: # The 'memory' store spills to the same SQLite file
+        store['db'] = sqlite3.connect(session_store_path + ".sqlite", check_same_thread=False)
+        store['db'].execute("CREATE TABLE IF NOT EXISTS stories (id TEXT PRIMARY KEY, data BLOB, updated REAL)")
+        store['db'].execute("DELETE FROM stories WHERE updated < ?", (time.time() - session_store_ttl,))
+        store['db'].commit()
+    return store
+
+# Function that packs the story of a session into its compact form: the story fields as compressed JSON. The state can be the session_state of the current session
+# or a plain dict of story fields. Finished background images and the token ledger are packed as part of the story, running jobs are left out. The story is tied
+# to its owner by the salted hash of their API key (see hashApiKey()).
+# Previews are packed with their full-quality picture if it is done already, otherwise as they are (a resumed story keeps them, the upgrade is not resumed).
+def packStory(state):
+    summary = state['story_summary'] if 'story_summary' in state and state['story_summary'] else {'text': "", 'covered': 0}
+    image_urls = [{key: value for key, value in image.items() if key != 'preview'} for image in state['image_urls']] if 'image_urls' in state else []
+    for upgrade in (state['image_upgrades'] if 'image_upgrades' in state else []):
+        if upgrade['future'].done() and not upgrade['future'].cancelled() and upgrade['future'].exception() is None and upgrade['index'] < len(image_urls):
+            image_urls[upgrade['index']].update(url=upgrade['future'].result()['url'], thumb=upgrade['future'].result()['thumb'])
+    for job in (state['image_jobs'] if 'image_jobs' in state else []):
+        if job['discarded']:
+            continue
+        for future in (job['upgrade'], job['future']): # The full-quality picture if it is done, otherwise the preview (also when the other one failed)
+            if future is not None and future.done() and not future.cancelled() and future.exception() is None:
+                image_urls.append({**future.result(), 'caption': job['caption']})
+                break
+    story = {
+        'chat_history': state['chat_history'],
+        'image_urls': image_urls,
+        'prompt_buttons': state['prompt_buttons'] if 'prompt_buttons' in state else [],
+        'conv_stage': state['conv_stage'] if 'conv_stage' in state else 0,
+        'summary': {'text': summary['text'], 'covered': summary['covered']},
+        'prompt_token_len': state['prompt_token_len'] if 'prompt_token_len' in state else 0,
+        'token_ledger': state['token_ledger'] if 'token_ledger' in state and state['token_ledger'] else None,
+        'owner': hashApiKey(state['api_key']) if 'api_key' in state and state['api_key'] else None,
+    }
+    return zlib.compress(json.dumps(story, separators=(',', ':')).encode("utf-8"))
+
+# Function that unpacks a story packed by packStory() into the session_state of the current session. A token ledger that is missing (or out of date) is rebuilt on first use.
+# If an owner (the hash of an API key) is given, a story of anyone else is left packed. Returns whether the story was unpacked.
+def unpackStory(data, owner=None):
+    story = json.loads(zlib.decompress(data))
+    if owner is not None and story.get('owner') != owner:
+        return False
+    st.session_state.chat_history = story['chat_history']
+    st.session_state.image_urls = story['image_urls']
+    st.session_state.prompt_buttons = story['prompt_buttons']
+    st.session_state.conv_stage = story['conv_stage']
+    st.session_state.story_summary = {**story['summary'], 'job': None}
+    st.session_state.prompt_token_len = story['prompt_token_len']
+    st.session_state.token_ledger = story.get('token_ledger') or False
+    return True
+
+# Function that writes a packed story to the store. The 'memory' store keeps it in its LRU and spills the least recently used stories beyond session_memory_size to disk.
+def storePut(story_id, data):
+    store = getSessionStore()
+    with store['lock']:
+        if store['kind'] == 'kv':
+            store['kv'][story_id] = struct.pack('d', time.time()) + data
+            return
+        if store['kind'] == 'memory':
+            store['memory'][story_id] = data
+            store['memory'].move_to_end(story_id)
+            if len(store['memory']) <= session_memory_size:
+                return
+            story_id, data = store['memory'].popitem(last=False)
+        store['db'].execute("INSERT OR REPLACE INTO stories VALUES (?, ?, ?)", (story_id, data, time.time()))
+        store['db'].commit()
+
+# Function that reads a packed story from the store, or returns None if there is none (or it has expired).
+def storeGet(story_id):
+    store = getSessionStore()
+    with store['lock']:
+        if store['kind'] == 'kv':
+            value = store['kv'].get(story_id)
+            if value is None or struct.unpack('d', value[:8])[0] < time.time() - session_store_ttl:
+                return None
+            return value[8:]
+        if story_id in store['memory']:
+            store['memory'].move_to_end(story_id)
+            return store['memory'][story_id]
+        row = store['db'].execute("SELECT data FROM stories WHERE id = ? AND updated >= ?", (story_id, time.time() - session_store_ttl)).fetchone()
+        return row[0] if row is not None else None
+
+# Function that deletes a story from the store (on logout and reset).
+def storeDelete(story_id):
+    store = getSessionStore()
+    with store['lock']:
+        if store['kind'] == 'kv':
+            if story_id in store['kv']:
+                del store['kv'][story_id]
+            return
+        store['memory'].pop(story_id, None)
+        store['db'].execute("DELETE FROM stories WHERE id = ?", (story_id,))
+        store['db'].commit()
+
+# Function that writes the story of the current session to the store. It is called whenever the story changes (a new turn, new pictures, a reset).
+# The digest of the written story is kept, so releaseStory() does not write it again if nothing has changed since.
+def saveStory():
+    if st.session_state.get('story_id') and 'chat_history' in st.session_state:
+        data = packStory(st.session_state)
+        storePut(st.session_state.story_id, data)
+        st.session_state.story_digest = hashlib.sha256(data).digest()
+
+# Function that makes sure the story of the current session is in the session_state. It is read from the store at the start of every run (see releaseStory()),
+# or when the parent reconnected with the story id in the url, otherwise a new story is started. The story id is kept in the url, so it survives reloads and reconnects. Only the owner of a story
+# (the same API key) can resume it, anyone else with the url starts a new story of their own.
+def loadStory():
+    if 'chat_history' not in st.session_state:
+        story_id = st.session_state.get('story_id') or st.query_params.get('story')
+        data = storeGet(story_id) if story_id else None
+        if data is None or not unpackStory(data, owner=hashApiKey(st.session_state.get('api_key') or "")):
+            story_id = secrets.token_urlsafe(16)
+            introMessage()
+        else:
+            st.session_state.story_digest = hashlib.sha256(data).digest()
+        st.session_state.story_id = story_id
+    if st.query_params.get('story') != st.session_state.story_id:
+        st.query_params['story'] = st.session_state.story_id
+
+# Helper function that tells whether the story of the current session still has work running in the background: pictures being painted (or waiting to be collected),
+# a summary being written, or a prompt waiting to be answered. Such a story stays in the session_state, the picture window keeps polling until the work is done.
+def hasBackgroundWork():
+    summary = getStorySummary() if 'chat_history' in st.session_state else None # Takes over a finished summary
+    return bool(st.session_state.get('prompt_callback') or st.session_state.get('image_jobs') or st.session_state.get('image_upgrades') or (summary and summary['job'] is not None))
+
+# Function that releases the story of the current session at the end of a run: it is written to the store (unless it is unchanged since it was last written) and dropped
+# from the session_state, so between runs the session only holds its story_id. loadStory() reads it back at the start of the next run. A full run releases the story
+# at the end of main(), a fragment running on its own at the end of the fragment (pass fragment=True). A session only ever releases its own story, from its own script
+# thread. Stories with background work (see hasBackgroundWork()) are left in the session_state until a later run.
+def releaseStory(fragment=False):
+    ctx = get_script_run_ctx()
+    if fragment and (ctx is None or not ctx.fragment_ids_this_run): # The fragment is part of a full run
+        return
+    if 'story_id' not in st.session_state or 'chat_history' not in st.session_state or hasBackgroundWork():
+        return
+    data = packStory(st.session_state)
+    if hashlib.sha256(data).digest() != st.session_state.get('story_digest'):
+        storePut(st.session_state.story_id, data)
+    for key in storyStateKeys:
+        if key in st.session_state:
+            del st.session_state[key]
 
 # Helper Function that cicrumvents a limitation of Streamlit not allowing reruns in a button callback (since a callback is called before a rerun already).
 # It saves the user-selected keyword prompt (from pressing one of the three buttons offered) in a session_state variable and resets the button list.
-# After the callback, a listening loop in the main function will pick up that prompt_callback is defined, and trigger the getBotResponse() function with the saved prompt.
+# After the callback, a listening loop in the chat window will pick up that prompt_callback is defined, and trigger the getBotResponse() function with the saved prompt.
 # There are certainly cleaner ways to solve this, but all previous attempts to generate the response within the callback resulted in the app layout being destroyed.
+# Only the chat window, the picture window and the debug panel are rerun (they are fragments, see main()), the rest of the page stays as it is.
 def buttonCallback(prompt):
     st.session_state.prompt_buttons = []
     st.session_state.prompt_callback = prompt
-    # No rerun here, since this is a callback function.
+    st.rerun(["chat", "pictures", "debug"])
+
+# Callback of the chat input, which hands the prompt over to the chat window the same way as buttonCallback() (but keeps the suggestions). Empty prompts are ignored.
+def chatInputCallback():
+    prompt = st.session_state.chat_prompt
+    if (prompt != None) and (prompt.strip() != ""):
+        st.session_state.prompt_callback = prompt
+        st.rerun(["chat", "pictures", "debug"])
 
 # Function that returns a hard-coded greeting message for the user upon starting a new chat. 
 # Using the OpenAI interface for this would be inefficient, since the text is not helpful for generating the messages, and thus should not be part of the prompt.
@@ -207,37 +1515,144 @@ def introMessage():
     addMessage("assistant", aiIntroMessages[random.randint(0,len(aiIntroMessages)-1)])
 
 
-# Helper Function to count the number of tokens in a given text with the tiktoken module.
-def count_tokens(input):
-    encoding = tiktoken.encoding_for_model(st.session_state.gpt_model)
+# Helper Function that resolves the tiktoken encoding for a given model. Resolving an encoding is surprisingly expensive (it loads the BPE ranks from disk or even from the web),
+# and Streamlit re-executes this script on every interaction, so the encoding is cached once per process with st.cache_resource instead of being looked up on every call.
+@st.cache_resource(show_spinner=False)
+def getEncoding(model):
+    import tiktoken # Helper package to calculate # of tokens needed
+    return tiktoken.encoding_for_model(model)
+
+# Helper Function to count the number of tokens in a given text with the tiktoken module. Callers counting many texts can pass the encoding they resolved once,
+# which saves the cache lookup of getEncoding() for every single text.
+def count_tokens(input, model=None, encoding=None):
+    encoding = encoding or getEncoding(model or st.session_state.gpt_model)
     encodedString=encoding.encode(input)
     return len(encodedString)
 
+# Helper Function that returns the number of tokens a single chat_history entry adds to the prompt. The stage-1 template passes the history as chat messages,
+# so an entry costs the tokens of its content plus the message_token_overhead of the message around it.
+def countMessageTokens(msg, model=None, encoding=None):
+    return count_tokens(msg['content'], model, encoding) + message_token_overhead
+
+# Function that returns the fixed token overhead of a prompt template, i.e. the length of the messages rendered with an empty chat history and an empty user prompt,
+# plus the JSON schema of the answer for models with structured output (see getResponseFormat()).
+# The overhead only depends on the conversation stage and the model (encoding), so it is computed once per process and then looked up.
+@st.cache_data(show_spinner=False)
+def getTemplateOverhead(conversation_stage, model):
+    messages = getPromptTemplate(conversation_stage).format_messages(userprompt = "")
+    response_format = getResponseFormat(conversation_stage, model)
+    schema_tokens = count_tokens(json.dumps(response_format['json_schema']), model) if response_format and response_format['type'] == 'json_schema' else 0
+    return sum(count_tokens(message.content, model) + message_token_overhead for message in messages) + reply_token_overhead + schema_tokens
+
+# Function that returns the per-session token ledger, a list holding the token count of every chat_history entry (same order, same length).
+# Each message is tokenized exactly once when addMessage() stores it. In case the ledger got out of sync (e.g. after a chat reset or a model with a different encoding
+# was selected in the sidebar), the missing entries are counted again here, so the ledger always matches the chat history it belongs to.
+def getTokenLedger():
+    chat_history = st.session_state.get('chat_history', [])
+    encoding = getEncoding(st.session_state.gpt_model)
+    ledger = st.session_state.get('token_ledger')
+    if not ledger or ledger['encoding'] != encoding.name or len(ledger['counts']) > len(chat_history):
+        ledger = {'encoding': encoding.name, 'counts': []}
+    for msg in chat_history[len(ledger['counts']):]:
+        ledger['counts'].append(countMessageTokens(msg, encoding=encoding))
+    st.session_state.token_ledger = ledger
+    return ledger['counts']
+
+# Function that returns the thread pool used for summarizing older story parts in the background. Like the other pools, it is created once per process.
+@st.cache_resource(show_spinner=False)
+def getSummaryExecutor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+# Function that runs the summary chain, merging the previous summary with the given messages. Runs on the summary thread, so everything it needs is passed in.
+@traced
+def summarizeMessages(client, summary, messages):
+    chain = getChain(client, 'summary')
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages) # One line per message, without the punctuation of a list of dicts
+    tokens = count_tokens(f"{summary} {transcript}", client.model_name) * 2 # The prompt, plus a generous guess for the summary itself
+    return scheduleCall(client, 'completion', lambda: chain.invoke({"summary": summary or "(none yet)", "chathistory": transcript}), tokens=tokens).strip()
+
+# Function that returns the running summary of the current story, i.e. a dict with the summary text and the number of messages it covers
+# (counted from the first message after the intro message). If a background summary job has finished in the meantime, its result is taken over first.
+def getStorySummary():
+    summary = st.session_state.get('story_summary') or {'text': "", 'covered': 0, 'job': None}
+    job = summary['job']
+    if job is not None and job['future'].done():
+        summary['job'] = None
+        if not job['future'].cancelled() and job['future'].exception() is None: # If summarizing failed, it is simply tried again on the next turn
+            summary['text'] = job['future'].result()
+            summary['covered'] = job['covered']
+    st.session_state.story_summary = summary
+    return summary
+
+# Function that starts summarizing older messages in the background once the messages not covered by the summary yet exceed summary_trigger_tokens.
+# All but the newest summary_keep_tokens worth of messages are merged into the summary. Until the job is done, those messages simply stay in the prompt.
+def updateStorySummary(summary, messages, message_tokens):
+    if summary['job'] is not None or sum(message_tokens) <= summary_trigger_tokens:
+        return
+    keep = len(messages)
+    kept_tokens = 0
+    while keep > 0 and kept_tokens + message_tokens[keep-1] <= summary_keep_tokens:
+        kept_tokens += message_tokens[keep-1]
+        keep -= 1
+    if keep == 0 or not st.session_state.get('api_key'): # Without an API key (e.g. when the history is trimmed outside of a logged-in session), no summary is written
+        return
+    client = getClients(st.session_state.api_key, routeModel('summary', st.session_state.gpt_model))[1]
+    future = submitTraced(getSummaryExecutor(), summarizeMessages, client, summary['text'], messages[:keep])
+    summary['job'] = {'future': future, 'covered': summary['covered'] + keep}
+
 # Function to manage the chat history length considering the token length of the total prompt, keeping within specified token limits.
 # The function is called by getBotResponse(), returning an adapted version of the chat history that together with the selected custom prompt will never exceed a pre-determined amount of tokens.
+# Instead of re-rendering and re-tokenizing the whole prompt each time a message is dropped, the function adds up the cached per-message token counts from the ledger
+# and simply looks for the oldest message that still fits (a suffix sum), so the cost of trimming stays linear in the number of messages.
+# The user prompt is not part of the returned history, the prompt templates send it as a message of its own after the history.
+# Messages that are already covered by the running story summary are left out, and the summary takes their place as the first entry of the history.
+# Since older messages are summarized before the history gets too long, the prompt size usually stays flat, and the trimming below is only a last resort.
+@traced
 def reduceChatHistoryLength(user_prompt, max_tokens=4000):
-    prompt = getPromptTemplate(st.session_state.conv_stage)
-    chat_history = st.session_state.chat_history[1:] # Do not include the first (hard-coded) intro message
+    summary = getStorySummary()
+    first = 1 + summary['covered'] # Do not include the first (hard-coded) intro message, nor the messages covered by the summary
+    chat_history = st.session_state.chat_history[first:]
+    message_tokens = getTokenLedger()[first:]
 
+    total_tokens = getTemplateOverhead(st.session_state.conv_stage, st.session_state.gpt_model) + count_tokens(user_prompt)
 
-    total_text = " ".join(prompt.format(chathistory = chat_history, userprompt= user_prompt))
-    total_tokens = count_tokens(total_text)
+    # Templates that do not reference the chat history (stage 0) are not affected by its length at all.
+    if usesChatHistory(st.session_state.conv_stage):
+        updateStorySummary(summary, chat_history, message_tokens)
+        summary_message = [{'role': 'system', 'content': f"Summary of the story so far: {summary['text']}"}] if summary['text'] else []
+        total_tokens += sum(countMessageTokens(msg) for msg in summary_message)
 
-    # Truncate chat history if the total tokens exceed the maximum allowed
-    while total_tokens > max_tokens and len(chat_history) > 1:
-        # Remove oldest entries until under limit
-        removed_text = chat_history.pop(0)
-        total_text = " ".join(prompt.format(chathistory = chat_history, userprompt= user_prompt))
-        total_tokens = count_tokens(total_text)
+        start, total_tokens = getHistoryStart(message_tokens, total_tokens, max_tokens)
+        chat_history = summary_message + chat_history[start:]
     st.session_state.prompt_token_len = total_tokens
     return chat_history
 
+# Helper function that returns the index of the oldest message to keep, together with the resulting prompt length: walking backwards from the newest message,
+# as many messages as fit into the token budget (on top of the used_tokens of the rest of the prompt) are kept. At least one message is always kept,
+# even if the newest message alone is too long, same as before (there is nothing left to remove).
+def getHistoryStart(message_tokens, used_tokens, max_tokens):
+    start = len(message_tokens)
+    while start > 0 and (start == len(message_tokens) or used_tokens + message_tokens[start-1] <= max_tokens):
+        used_tokens += message_tokens[start-1]
+        start -= 1
+    return start, used_tokens
+
+# Session-free variant of reduceChatHistoryLength() for callers that keep the chat history themselves (e.g. the batch generation, see storybot_batch.py).
+# Returns the trimmed chat history together with the prompt length in tokens. There is no running summary here, so it is meant for stories of a few turns.
+def trimChatHistory(chat_history, user_prompt, conversation_stage, model, max_tokens=4000):
+    total_tokens = getTemplateOverhead(conversation_stage, model) + count_tokens(user_prompt, model)
+    if not usesChatHistory(conversation_stage):
+        return chat_history, total_tokens
+    start, total_tokens = getHistoryStart([countMessageTokens(msg, model) for msg in chat_history], total_tokens, max_tokens)
+    return chat_history[start:], total_tokens
+
 
 
 
 ### * 04 MAIN FUNCTION * ###
 # Where all the frontend layouting and function calling happens. This is the core of my streamlit application.
 
+@traced
 def main():
 
     # Set the streamlit layout to 'wide' to get more space, and make sure the sidebar is visible per default.
@@ -267,6 +1682,9 @@ def main():
     if not st.session_state.logged_in:
 
         st.sidebar.info("You are not logged in. Please provide a valid OpenAI API key to continue.")
+        if 'story' in st.query_params: # The parent has been here before (e.g. the connection dropped), their story is waiting in the session store
+            st.sidebar.info("Welcome back! Log in again to continue your story.")
+        preloadPackages()
         
         st.title("Welcome to BedtimeBuddy 🦄")
         st.subheader("Your Nightly Dose of ✨ Dream Dust! ✨")
@@ -302,6 +1720,10 @@ def main():
     # in the pictures column. On the sidebar, various settings and controls will become accessible.
     else:
 
+        # In case the dashboard is loaded for the first time after login, either resume the story from the session store (if the url has a story id) or start a new story with
+        # a new intro message persisted in the session_state (will be handled by the introMessage() function). On every other run, the story is read back from the session store.
+        loadStory()
+
         # ** SIDEBAR ** #
         st.sidebar.success("You are logged in.")
         st.sidebar.write("Feeling sleepy? Log out to prevent unauthorized use. Your API key will not be stored permanently in this program.")
@@ -329,19 +1751,61 @@ def main():
             index=1, # dall-e-3 is the default model
             help="Dall-E 2 costs approx. 0.02\$/image, DALL-E 3 about 0.04\$/image.",
         )
+        cache_toggle = st.sidebar.toggle(
+            'Cache stories and images',
+            value=False, # The cache is opt-in, since it replays earlier answers instead of writing new ones
+            help="Reuses earlier answers and pictures for exactly the same requests (e.g. when replaying a demo story), which saves time and money.",
+        )
+        prefetch_toggle = st.sidebar.toggle(
+            'Prefetch suggestions',
+            value=False, # Prefetching is opt-in, since most of the prefetched continuations are never read
+            help="Writes the continuations for all three suggestions in the background while you read, so clicking a suggestion shows the next part right away. This uses more tokens.",
+        )
+        hedge_toggle = st.sidebar.toggle(
+            'Hedge slow requests',
+            value=False, # Hedging is opt-in, since a hedged request is sometimes paid for twice
+            help="If the story takes unusually long to start, the same request is also sent to the fastest model, and whichever answers first is used. This uses more tokens.",
+        )
+        progressive_toggle = st.sidebar.toggle(
+            'Progressive pictures',
+            value=False, # Progressive pictures are opt-in, since the preview is paid for on top of the full-quality picture
+            help="Shows a quick, small preview of every picture first, and replaces it with the full-quality picture once that is done. Each preview costs about 0.016\$ extra.",
+        )
+        stream_toggle = st.sidebar.toggle(
+            'Stream story text',
+            value=True, # Streaming is the default, since seeing the first words early makes the wait feel much shorter
+            help="Shows the story word by word while it is being written, instead of waiting for the whole story part.",
+        )
         st.sidebar.divider()
 
-        st.sidebar.caption(f"Debug: Stage {st.session_state.conv_stage}, Token Length {st.session_state.prompt_token_len}") # Initially for debug purposes, decided to keep it since it might be interesting
+        # The debug captions and the timings panel are a fragment, too, which is rerun together with the chat window and the picture window on every turn
+        # (see buttonCallback()), so they show the numbers of the turn that has just finished instead of waiting for the next full rerun.
+        @st.fragment(key="debug")
+        def debugPanel():
+            loadStory() # The fragment can run on its own, the story has been released to the session store at the end of the previous run
+            st.caption(f"Debug: Stage {st.session_state.conv_stage}, Token Length {st.session_state.prompt_token_len}") # Initially for debug purposes, decided to keep it since it might be interesting
+            if cache_toggle:
+                cache_stats = st.session_state.get('cache_stats', {'hits': 0, 'misses': 0})
+                st.caption(f"Debug: Cache {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+            if prefetch_toggle:
+                prefetch_stats = getPrefetchState()['stats']
+                st.caption(f"Debug: Prefetch {prefetch_stats['hits']} hits, {prefetch_stats['misses']} misses, {prefetch_stats['spent']}/{prefetch_token_budget} tokens spent, {prefetch_stats['wasted']} wasted")
+            showTelemetryPanel()
+            releaseStory(fragment=True)
+
+        with st.sidebar:
+            debugPanel()
 
 
         # ** INITIALIZATIONS **
         # Initialize the model choices in the st session_state regularly on app rerun
         st.session_state.gpt_model=gpt_model_selector
         st.session_state.dalle_model=dalle_model_selector
-
-        # In case the dashboard is loaded for the first time after login, generate a new intro message and persist it in the session_state (will be handled by the introMessage() function)
-        if 'chat_history' not in st.session_state:
-            introMessage()
+        st.session_state.stream_response=stream_toggle
+        st.session_state.use_cache=cache_toggle
+        st.session_state.prefetch_enabled=prefetch_toggle
+        st.session_state.hedge_requests=hedge_toggle
+        st.session_state.progressive_images=progressive_toggle
 
         # In case the dashboard is loaded for the first time after login, create an empty list for images to be generated
         if 'image_urls' not in st.session_state:
@@ -351,9 +1815,15 @@ def main():
         if 'prompt_buttons' not in st.session_state:
             st.session_state.prompt_buttons = []
 
-        # Initialize OpenAI objects with provided credentials (which are already validated, so no need to double-check here)
-        dalle = OpenAI(api_key=st.session_state.api_key) # For image generation and content moderation (validation)
-        chat_openai_client = ChatOpenAI(model=st.session_state.gpt_model, openai_api_key=st.session_state.api_key) # For response generation via langchain
+        # In case the dashboard is loaded for the first time after login, create an empty list for the images generating in the background
+        if 'image_jobs' not in st.session_state:
+            st.session_state.image_jobs = []
+        if 'image_upgrades' not in st.session_state: # Full-quality pictures replacing their previews (progressive pictures)
+            st.session_state.image_upgrades = []
+
+        # Get the OpenAI objects for the provided credentials (which are already validated, so no need to double-check here) from the client pool
+        # dalle: For image generation and content moderation (validation), chat_openai_client: For response generation via langchain
+        dalle, chat_openai_client = getClients(st.session_state.api_key, st.session_state.gpt_model)
 
         # * MAIN APP LAYOUT * #
         st.title("BedtimeBuddy 🦄")
@@ -361,123 +1831,215 @@ def main():
         col1, col2 = st.columns((75,25)) # Chat window is the primary focus, images are generated on the side
 
         # * CHAT WINDOW * #
+        # The story up to now is only shown on a full rerun of the app. Everything that happens in the chat afterwards (new story parts, the suggestion buttons and
+        # the chat input) belongs to the chatWindow fragment below, which the callbacks of the buttons and the chat input rerun on its own, together with the picture window.
+        # The fragment appends the new messages to the ones shown on the last full rerun (chat_shown), so a turn takes the same time, no matter how long the story is.
         with col1.container(border=1):
             st.subheader("Chat")
             showChatHistory()
+            st.session_state.chat_shown = len(st.session_state.chat_history)
 
             # Function responsible for submitting a new prompt to the chat and for generating and displaying the corresponsing AI response.
             # Although most functions are declared in a different part of the program, I figured that placing this elsewhere would mess with the
             # creation of chat message previews - thus, unfortunately - this needs to stay here in order for the program to display messages correctly.
             def submitPrompt(prompt, chat_openai_client):
+                getSessionTelemetry()['turn'] += 1 # Every prompt starts a new turn in the telemetry, all spans recorded from now on belong to it
+                image_job = None
+                turn_added = False
                 try: # Since a lot can go wrong in creating a prompt (e.g., service not available, lack of funds, response policy violations...), I decided to catch these errors altogether.
-                    if checkContentViolation(dalle,prompt): # If the user input vialates the moderation policy of OpenAI, the prompt will not be considered and a warning will be displayed.
-                            st.warning("Sorry, this prompt violates OpenAI's content policies and might not be suitable for children. It has not been added to your chat history. Please choose a different prompt.")
-                    else: # In all other cases, the message will be added to the chat_history, but since the rerun will happen later, a live 'preview' widget will be created, too.
-                        addMessage("user", prompt)
-                        with st.chat_message("user"):
+                    # The user input is checked against the moderation policy of OpenAI. In speculative mode, the check runs in the background while the story is already being
+                    # written, and is only awaited right before anything is shown to the user. If the input violates the policy, the completion is thrown away.
+                    input_check = startModeration(dalle, prompt) if speculative_moderation else None
+                    if input_check is None and checkContentViolation(dalle, prompt):
+                        st.warning(flaggedInputWarning)
+                        return
+
+                    # The user message only makes it into the chat_history once the whole turn has passed moderation. Until then, it is only sent as the user prompt.
+                    user_container = st.container() # Reserves the spot for the user message preview above the assistant message
+                    assistant_slot = st.empty() # Allows removing the assistant message preview again if something gets flagged
+
+                    # Helper that waits for the input moderation (if it is still running) and shows the user message preview once the input has been cleared.
+                    def inputCleared():
+                        if input_check is not None and input_check.result(timeout=moderation_timeout):
+                            return False
+                        with user_container.chat_message("user"):
                             st.markdown(prompt)
+                        return True
 
-                        # The response creation is going to take some time. Since we cannot stream the response because we expect a JSON object, a spinner is displayed informing
-                        # the user that the bot is working, thereby enhancing the user experience.
-                        with st.chat_message("assistant"):
-                            with st.spinner("Writing a great story, hold tight..."):
+                    # If the continuation for this prompt has been prefetched (the user clicked one of the suggestions), it is used right away.
+                    prefetched = takePrefetch(prompt)
 
+                    # The response creation is going to take some time. If streaming is turned on, the story is rendered token by token as soon as it arrives,
+                    # otherwise a spinner is displayed informing the user that the bot is working, thereby enhancing the user experience.
+                    output_check = None
+                    with assistant_slot.container():
+                        with st.chat_message("assistant"):
+                            if prefetched is not None:
+                                response, prefetched_image = prefetched
+                                input_ok = inputCleared()
+                                if input_ok:
+                                    st.markdown(response["story"])
+                                    if prefetched_image is not None: # The picture has been prefetched, too
+                                        image_future = Future()
+                                        image_future.set_result(prefetched_image)
+                                        image_job = addImageJob(image_future, response["dalle-prompt"])
+                                        output_check = startModeration(dalle, [response["story"], response["dalle-prompt"]])
+                            elif st.session_state.stream_response:
+                                story_placeholder = st.empty()
+                                story_placeholder.markdown("_Writing a great story, hold tight..._")
+                                response = {}
+                                input_ok = None
+                                for response, completed in streamBotResponse(chat_openai_client,prompt):
+                                    # Nothing of the story is shown before the input moderation has returned. By then, the completion request is already on its way.
+                                    if input_ok is None:
+                                        input_ok = inputCleared()
+                                    if not input_ok:
+                                        break # Closing the stream discards the rest of the completion
+                                    if response.get("story"):
+                                        story_placeholder.markdown(response["story"] + " ▌") # Cursor indicating that the story is still being written
+                                    # The image prompt is picked up as soon as it is complete, and the picture starts painting while the rest of the answer is still streaming in.
+                                    # At the same time, the story and the image prompt are sent to moderation.
+                                    if "dalle-prompt" in completed and image_job is None:
+                                        image_job = startImageJob(dalle, response["dalle-prompt"])
+                                        output_check = startModeration(dalle, [response["story"], response["dalle-prompt"]])
+                                if input_ok is None: # The stream ended without yielding anything, so the moderation still needs to be awaited
+                                    input_ok = inputCleared()
+                                if input_ok:
+                                    story_placeholder.markdown(response["story"])
+                            else:
+                                with st.spinner("Writing a great story, hold tight..."):
                                     # Then, the actual response generation mechanism is triggered.
                                     response = getBotResponse(chat_openai_client,prompt)
-                                    # In case that is successful, we add the response to the chat_history.
-                                    addMessage("assistant", response["story"])
-
-                                    # Next up is the generation of an image accompanying the story fragment. But we do not want the user to wait any longer to read the text.
-                                    # Thus, I am performing a similar trick as with the toast message listener: The "Task" of generating a picture is persisted in the session_state,
-                                    # and an app rerun is triggered. As soon as the app reruns, a listener in the main function will notice that the dalle_task variable is defined,
-                                    # and will trigger the generation of t a dall-e image. While this is happening, the story bit is already visible for the user to read, thus reducing
-                                    # the waiting time by splitting it up into two tasks.
-                                    st.session_state.dalle_task = response["dalle-prompt"]
-                                    # I will also turn off the editing capabilities of the chat input to avoid further user inputs before the image is done generating.
-                                    st.session_state.prompt_disabled = True
-
-                                    # If the conversation stage is already at 1, this means that the GPT model has generated some keyword options on how the story should continue.
-                                    # The following code will persist these options in the session_state so that they will be rendered as buttons above the chat input on the next app rerun.
-                                    if (st.session_state.conv_stage == 1):
-                                        st.session_state.prompt_buttons = []
-                                        try:
-                                            for i in range(1, 4):
-                                                if response[f"opt{i}"] == '': # Sometimes, gpt-3 generates empty option values for the buttons when it is told to write a story end. I am counting this as a story end and will reset the conversation stage to 0, making way for the next story to be created.
-                                                    raise Exception
-                                                else:
-                                                    st.session_state.prompt_buttons.append(response[f"opt{i}"]) # Persist the currently generated set of options for later rendering as buttons
-                                        except Exception as e:
-                                            st.session_state.toast_msg = "No buttons are displayed, as the story reached its end (or an error occurred)."
-                                            st.session_state.conv_stage = 0
-                                            st.rerun()
-
-                                    # If everything completes without errors, we have done at least one iteration with the chatbot, so the next time, the response should include
-                                    # keyword suggestions for future prompts. Thus, updating the conversation stage to 1.
-                                    st.session_state.conv_stage = 1
-
-                                    # Finally, rerun the app to reflect all changes.
-                                    st.rerun()
+                                    input_ok = inputCleared()
+                                if input_ok:
+                                    st.markdown(response["story"])
+
+                    if not input_ok:
+                        assistant_slot.empty()
+                        st.warning(flaggedInputWarning)
+                        return
+
+                    # Next up is the generation of an image accompanying the story fragment. But we do not want the user to wait any longer to read the text.
+                    # Thus, the picture is generated as a background job (if streaming has not started it already), which the picture window keeps polling
+                    # until the image is done. In the meantime, the user can already read the story bit and even continue the story.
+                    # The story and the image prompt are moderated in the background, too, while the image is being generated.
+                    if image_job is None:
+                        image_job = startImageJob(dalle, response["dalle-prompt"])
+                        output_check = startModeration(dalle, [response["story"], response["dalle-prompt"]])
+
+                    # If the assistant output violates the moderation policy, the story part is removed again, and neither the story nor the image are kept.
+                    if output_check.result(timeout=moderation_timeout):
+                        discardImageJob(image_job)
+                        assistant_slot.empty()
+                        st.warning(flaggedOutputWarning)
+                        return
+
+                    # In case that is successful, we add the user prompt and the response to the chat_history, and record the tokens used in the telemetry.
+                    addMessage("user", prompt)
+                    addMessage("assistant", response["story"])
+                    turn_added = True
+                    # Answers and pictures from the response cache cost nothing
+                    cached = st.session_state.response_cached
+                    recordTurn(st.session_state.response_model, 0 if cached else st.session_state.prompt_token_len, 0 if cached else count_tokens(json.dumps(response)),
+                               None if image_job['cached'] else st.session_state.dalle_model, progressive_image=image_job['upgrade'] is not None)
+
+                    # If the conversation stage is already at 1, this means that the GPT model has generated some keyword options on how the story should continue.
+                    # The following code will persist these options in the session_state so that they will be rendered as buttons above the chat input right below.
+                    # An answer without any options (or with 'end' set) is the end of the story. A single empty option does not end the story, the others are still shown.
+                    story_ended = False
+                    if (st.session_state.conv_stage == 1):
+                        st.session_state.prompt_buttons = getStoryOptions(response)
+                        if not st.session_state.prompt_buttons:
+                            st.session_state.toast_msg = "No buttons are displayed, as the story reached its end."
+                            display_toast_msg()
+                            story_ended = True
+
+                    # If everything completes without errors, we have done at least one iteration with the chatbot, so the next time, the response should include
+                    # keyword suggestions for future prompts. Thus, updating the conversation stage to 1 (or back to 0, if the story has come to an end).
+                    st.session_state.conv_stage = 0 if story_ended else 1
+
+                    # While the parent reads the new story part, the continuations for the suggestions can already be generated in the background.
+                    if st.session_state.prefetch_enabled and st.session_state.prompt_buttons and not story_ended:
+                        startPrefetch(chat_openai_client, dalle)
+
+                    # Finally, write the story to the session store. There is no need for a rerun: the new messages are already shown, and the suggestion buttons
+                    # and the chat input are rendered right after this function returns.
+                    saveStory()
                 # In case anything did not work out as intended, show an error message to the user, allowing them to retry the prompt.
+                # A picture that was started for a story part that did not make it into the chat_history is thrown away, like for flagged output.
                 except Exception as e:
+                        if image_job is not None and not turn_added:
+                            discardImageJob(image_job)
                         st.error(f"Whoops, something did not work out as expected. Maybe your input violated a content policy? You can try again and see if the next attempt runs smoothly. {e}")
 
-            # Listening Function: If a button callback has been persisted, that means that the user has pressed a suggestion button. The following code triggers a bot response
-            # based on the prompt of the button pressed, then resets the variable in session_state to avoid infinite loops.
-            if st.session_state.prompt_callback:
-                prompt = st.session_state.prompt_callback
-                st.session_state.prompt_callback = False
-                submitPrompt(prompt, chat_openai_client)
-
-            # If the conversation stage is at 1 (at least one manual user input has happened already), and the previous bot responses has generated suggestion prompts, show them as buttons.
-            if (st.session_state.conv_stage == 1 and st.session_state.prompt_buttons != []):
-                st.markdown("**Here's what could happen:**")
-                btncol1, btncol2, btncol3 = st.columns(3)
-                with btncol1:
-                    st.button(st.session_state.prompt_buttons[0], 
-                                disabled=st.session_state.prompt_disabled, # The buttons are disabled if the image for the previous story piece is still generating.
-                                on_click=buttonCallback, # If the button is clicked, the callback function will persist its value which will then be picked up by the listening function above
-                                args=[st.session_state.prompt_buttons[0]], # Argument for the callback function (simply the suggested prompt of the button)
-                                use_container_width=True)
-                with btncol2:
-                    st.button(st.session_state.prompt_buttons[1], 
-                                disabled=st.session_state.prompt_disabled, 
-                                on_click=buttonCallback, 
-                                args=[st.session_state.prompt_buttons[1]], 
-                                use_container_width=True)
-                with btncol3:
-                    st.button(st.session_state.prompt_buttons[2],
-                                disabled=st.session_state.prompt_disabled, 
-                                on_click=buttonCallback, 
-                                args=[st.session_state.prompt_buttons[2]],
-                                use_container_width=True)
-
-            
-            # Show a chat input at the bottom of the chat window, allowing user input (as long as there is no picture generation underway). 280 characters (a Twitter message) should be enough input.
-            prompt = st.chat_input(getChatInputPrompt(), max_chars=280, disabled=st.session_state.prompt_disabled)
-            
-            # Only allow the user to submit non-empty prompts. Use the GPT model selected by the user to trigger a bot response.
-            if (prompt != None) and (prompt.strip() != ""):
-                submitPrompt(prompt, chat_openai_client)
+            # The chat window fragment. Besides on full reruns, it runs on its own whenever the parent submits a prompt or clicks a suggestion (see buttonCallback()).
+            @st.fragment(key="chat")
+            @traced
+            def chatWindow():
+                loadStory() # The fragment can run on its own, the story has been released to the session store at the end of the previous run
+                showChatHistory(st.session_state.chat_shown) # The messages added since the last full rerun
+
+                # Listening Function: If a callback has persisted a prompt, that means that the user has submitted a prompt or pressed a suggestion button. The following code
+                # triggers a bot response based on that prompt, then resets the variable in session_state to avoid infinite loops.
+                if st.session_state.prompt_callback:
+                    prompt = st.session_state.prompt_callback
+                    st.session_state.prompt_callback = False
+                    submitPrompt(prompt, chat_openai_client)
+
+                # If the conversation stage is at 1 (at least one manual user input has happened already), and the previous bot responses has generated suggestion prompts, show them as buttons.
+                if (st.session_state.conv_stage == 1 and st.session_state.prompt_buttons != []):
+                    st.markdown("**Here's what could happen:**")
+                    for column, option in zip(st.columns(3), st.session_state.prompt_buttons):
+                        with column:
+                            st.button(option,
+                                        on_click=buttonCallback, # If the button is clicked, the callback function will persist its value which will then be picked up by the listening function above
+                                        args=[option], # Argument for the callback function (simply the suggested prompt of the button)
+                                        width="stretch")
+
+                # Show a chat input at the bottom of the chat window, allowing user input (even while a picture is still being generated). 280 characters (a Twitter message) should be enough input.
+                # Submitted prompts are picked up by its callback, which only allows non-empty prompts and reruns the chat window to trigger a bot response.
+                st.chat_input(getChatInputPrompt(), max_chars=280, key="chat_prompt", on_submit=chatInputCallback)
+                releaseStory(fragment=True)
+
+            chatWindow()
 
         # * PICTURE WINDOW * #
+        # Like the chat window, the pictures of the story up to now are only shown on a full rerun, and the pictureWindow fragment appends the ones finished since then
+        # (images_shown). It is rerun together with the chat window on every turn. As long as there are images generating in the background, it includes the pollPictures
+        # fragment, which checks for finished images every image_poll_interval seconds without interrupting whatever the user is doing in the chat window. Once there
+        # is nothing left to wait for, pollPictures is left out on the next rerun of the picture window, which stops the polling.
+        # Previews (progressive pictures) are always left to the fragment, which shows them again on every poll, so their full-quality pictures replace them in place.
+        @traced
+        def showNewPictures():
+            loadStory() # The fragments can run on their own, the story has been released to the session store at the end of the previous run
+            # Move all finished images from the background jobs to the image list. If something went wrong, inform the user there was a problem with generating the image.
+            for e in collectImageJobs():
+                st.error(f"Whoops, something did not work out as expected. Maybe your input violated a content policy? You can try again and see if the next attempt runs smoothly. {e}")
+            showImages(st.session_state.images_shown)
+            if st.session_state.get('image_jobs'):
+                st.caption("🎨 Creating a stunning Picture...")
+            elif st.session_state.get('image_upgrades'):
+                st.caption("🎨 Adding the finishing touches...")
+            releaseStory(fragment=True)
+
+        @st.fragment(run_every=image_poll_interval)
+        def pollPictures():
+            showNewPictures()
+
+        @st.fragment(key="pictures")
+        def pictureWindow():
+            if hasBackgroundWork(): # Pictures, but also a summary that is still being written, so the story is released once it is done
+                pollPictures()
+            else:
+                showNewPictures()
+
         with col2.container(border=1):
             st.subheader("Images")
             st.markdown("Pictures accompanying the storyline will appear here.")
-            # Include all images generated so far
-            showImages()
-
-            # Checks every rerun if a picture generation task has been stored prior to executing the rerun, and triggers that generation if necessary.
-            # It resets the variables and also enables the chat message input again, so no threat of infinite loops.
-            if st.session_state.dalle_task != False:
-                # Since the image generation might also take some time, show the user a spinner widget to indicate the bot is working, thereby enhancing user experience
-                with st.spinner("Creating a stunning Picture..."):
-                    try:
-                        addImage(generateImage(dalle, st.session_state.dalle_task), st.session_state.dalle_task)
-                        st.session_state.prompt_disabled = False
-                        st.session_state.dalle_task = False
-                        st.rerun()
-                    except Exception as e: # If something goes wrong, catch any exception and inform the user there was a problem with generating the image
-                            st.error(f"Whoops, something did not work out as expected. Maybe your input violated a content policy? You can try again and see if the next attempt runs smoothly. {e}")
+            # Include all (final) images generated so far
+            st.session_state.images_shown = countFinalImages()
+            showImages(0, st.session_state.images_shown)
+            pictureWindow()
 
         # Disclaimer text - although the prompt template and moderation function should take care of most non-complying in- and output, I don't want to risk it.
         st.info("Attention Parents: BedtimeBuddy is made for a kids audience. Our bot will not consider input that is not appropriate for children or that is against OpenAI's content policies. Nevertheless, the bot can make mistakes, and any resemblance to real events or people is coincidental. Parental guidance is strongly advised.")
@@ -486,16 +2048,27 @@ def main():
         # RESET BUTTON HANDLER - resets most (not all) session_state variables related to the current chat, then triggers an accompanying toast message and reruns the app.
         if reset:
             st.session_state.chat_history = []
+            st.session_state.token_ledger = False
+            st.session_state.story_summary = False
             st.session_state.image_urls = []
             st.session_state.prompt_buttons = []
-            st.session_state.dalle_task = False
+            cancelImageJobs()
+            cancelPrefetch()
             st.session_state.conv_stage = 0
             st.session_state.toast_msg = 'Chat has been reset successfully!'
             introMessage()
+            storeDelete(st.session_state.story_id) # The new story gets a new id, so the old url does not lead anywhere anymore
+            st.session_state.story_id = secrets.token_urlsafe(16)
+            saveStory()
             st.rerun()
         
         # RESET BUTTON HANDLER - resets the entire session_state, then triggers an accompanying toast message and reruns the app.
         if logout:
+            cancelImageJobs()
+            cancelPrefetch()
+            evictClients(st.session_state.api_key) # Drop the pooled clients for this key, so they do not outlive the session
+            storeDelete(st.session_state.story_id) # Logging out ends the story, so it cannot be resumed from the url anymore
+            st.query_params.pop('story', None)
             st.session_state.logged_in = False
             for key in st.session_state.keys():
                 del st.session_state[key]
@@ -503,6 +2076,9 @@ def main():
             st.session_state.toast_msg = "Logged out successfully. Sweet dreams!"
             st.rerun()
 
+        # Finally, the story is released to the session store until the next run.
+        releaseStory()
+
 
 # Lastly, call the main function of the script.
 if __name__ == "__main__":
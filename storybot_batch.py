@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# File: WMCC Storybot - Batch story generation
+#
+# Writes a whole library of complete, illustrated bedtime stories without the Streamlit UI, e.g. as a nightly job. Every theme (one per line in the themes file)
+# becomes a story: a beginning (stage 0), a number of continuations (stage 1, each following one of the suggestions of the previous part) and an ending.
+# It uses the very same prompt templates, moderation, image generation and request scheduler as the app (storybot.py), so the rate limits of the API key are
+# respected, and the number of stories per minute grows with the number of workers until the rate limits are reached.
+#
+#   python storybot_batch.py themes.txt --out library --workers 4 --continuations 3
+#
+# The API key is taken from OPENAI_API_KEY (or --api-key). The stories are appended to <out>/stories.jsonl, their pictures are saved in <out>/images.
+# Every finished story part is also written to <out>/checkpoint.jsonl, so an interrupted run simply picks up where it left off when started again.
+# Stories that could not be written (e.g. flagged by the moderation) are listed in <out>/errors.jsonl and tried again on the next run.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import storybot
+
+continue_prompt = "What happens next?" # After the beginning, there are no suggestions to follow yet
+ending_prompt = "Please end the story now, with a happy ending."
+
+
+# Silences the 'missing ScriptRunContext' warnings of streamlit's bare mode (streamlit sets the level of each of its loggers individually).
+def quietStreamlit():
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+# Returns the id of a story, made up of its position in the themes file and a hash of its theme, so it stays the same across runs.
+def getStoryId(index, theme):
+    return f"{index:05d}-{hashlib.sha256(theme.encode('utf-8')).hexdigest()[:8]}"
+
+def readJsonl(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Appends a record to a JSON lines file. Records are written in one go under the lock, so the workers do not interleave their lines.
+writeLock = threading.Lock()
+def appendJsonl(path, record):
+    with writeLock, open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+# Returns the story parts that have already been written (by an earlier, interrupted run), per story id and in order.
+def loadCheckpoint(out_dir):
+    parts = {}
+    for record in readJsonl(os.path.join(out_dir, "checkpoint.jsonl")):
+        story_parts = parts.setdefault(record["story_id"], [])
+        if record["part"]["index"] == len(story_parts):
+            story_parts.append(record["part"])
+    return parts
+
+# Writes a single story. Each part goes through the same steps as a turn in the app: input moderation, trimming the history, writing the story part and output
+# moderation. The picture of a part is painted in the background while the next part is being written. Returns the finished story record.
+def writeStory(story_id, theme, clients, settings, done_parts, image_pool):
+    dalle, chat_client = clients
+    out_dir = settings["out_dir"]
+    started = time.perf_counter()
+    generator = random.Random(story_id) # Picking the suggestions to follow is repeatable, so a resumed story continues the same way
+    steps = [(0, theme)] + [(1, None)] * settings["continuations"] + [(1, ending_prompt)]
+    parts = list(done_parts)
+    chat_history = []
+    for part in parts:
+        chat_history += [{'role': 'user', 'content': part["prompt"]}, {'role': 'assistant', 'content': part["story"]}]
+
+    images = {}
+    for index in range(len(parts), len(steps)):
+        stage, prompt = steps[index]
+        if prompt is None and parts[-1]["stage"] == 0:
+            prompt = continue_prompt
+        elif prompt is None:
+            if not parts[-1]["options"]: # The story has already come to an end by itself
+                break
+            prompt = generator.choice(parts[-1]["options"])
+        if storybot.checkContentViolation(dalle, prompt):
+            raise ValueError(f"Prompt flagged by the moderation: {prompt}")
+        history, prompt_tokens = storybot.trimChatHistory(chat_history, prompt, stage, settings["model"])
+        response, model = storybot.writeStoryPart(chat_client, stage, history, prompt, prompt_tokens + storybot.completion_token_estimate, hedge=settings["hedge"])
+        if storybot.checkContentViolation(dalle, [response["story"], response["dalle-prompt"]]):
+            raise ValueError(f"Story part {index} flagged by the moderation")
+        storybot.recordTurn(model, prompt_tokens, storybot.count_tokens(json.dumps(response), model),
+                            settings["dalle_model"] if settings["images"] else None)
+
+        part = {'index': index, 'stage': stage, 'model': model, 'prompt': prompt, 'story': response["story"], 'dalle-prompt': response["dalle-prompt"],
+                'options': storybot.getStoryOptions(response) if stage == 1 else []}
+        appendJsonl(os.path.join(out_dir, "checkpoint.jsonl"), {'story_id': story_id, 'part': part})
+        parts.append(part)
+        chat_history += [{'role': 'user', 'content': prompt}, {'role': 'assistant', 'content': response["story"]}]
+        if settings["images"]:
+            images[index] = image_pool.submit(storybot.generateImage, dalle, part["dalle-prompt"], settings["dalle_model"])
+
+    # Pictures of parts written by an earlier run are painted now, unless they are already in the library.
+    for part in parts:
+        image_path = os.path.join(out_dir, "images", f"{story_id}-{part['index']}.png")
+        if settings["images"] and part['index'] not in images and not os.path.exists(image_path):
+            images[part['index']] = image_pool.submit(storybot.generateImage, dalle, part["dalle-prompt"], settings["dalle_model"])
+    for index, future in images.items():
+        shutil.copyfile(future.result()['url'], os.path.join(out_dir, "images", f"{story_id}-{index}.png"))
+    for part in parts:
+        image_path = os.path.join("images", f"{story_id}-{part['index']}.png")
+        part['image'] = image_path if os.path.exists(os.path.join(out_dir, image_path)) else None
+
+    return {'id': story_id, 'theme': theme, 'model': settings["model"], 'dalle_model': settings["dalle_model"] if settings["images"] else None,
+            'parts': parts, 'duration': round(time.perf_counter() - started, 2)}
+
+# Writes stories for all given themes with a pool of workers, skipping the stories that are already in the library. Returns a summary of the run.
+# This is the entry point for using the batch generation as a library, main() only parses the command line.
+def runBatch(themes, out_dir, api_key, workers=4, continuations=3, model=storybot.gpt_model_options[0], dalle_model=storybot.dalle_model_options[0], images=True, hedge=False):
+    os.makedirs(os.path.join(out_dir, "images"), exist_ok=True)
+    settings = {'out_dir': out_dir, 'continuations': continuations, 'model': model, 'dalle_model': dalle_model, 'images': images, 'hedge': hedge}
+    done = {record["id"] for record in readJsonl(os.path.join(out_dir, "stories.jsonl"))}
+    checkpoint = loadCheckpoint(out_dir)
+    todo = [(getStoryId(index, theme), theme) for index, theme in enumerate(themes) if getStoryId(index, theme) not in done]
+    clients = storybot.getClients(api_key, model)
+
+    summary = {'stories': 0, 'errors': 0, 'skipped': len(themes) - len(todo), 'duration': 0.0}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="story") as story_pool, ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image") as image_pool:
+        futures = {story_pool.submit(writeStory, story_id, theme, clients, settings, checkpoint.get(story_id, []), image_pool): (story_id, theme) for story_id, theme in todo}
+        for future in as_completed(futures):
+            story_id, theme = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                summary['errors'] += 1
+                appendJsonl(os.path.join(out_dir, "errors.jsonl"), {'id': story_id, 'theme': theme, 'error': str(e), 'time': time.time()})
+                print(f"Failed {story_id} ({theme}): {e}", flush=True)
+                continue
+            appendJsonl(os.path.join(out_dir, "stories.jsonl"), record)
+            summary['stories'] += 1
+            print(f"[{summary['stories'] + summary['errors']}/{len(todo)}] {story_id} done in {record['duration']:.1f}s ({len(record['parts'])} parts)", flush=True)
+    summary['duration'] = time.perf_counter() - started
+    summary['stories_per_minute'] = summary['stories'] / summary['duration'] * 60 if summary['duration'] else 0.0
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a library of complete, illustrated bedtime stories from a list of themes, without the Streamlit UI.")
+    parser.add_argument("themes", help="Text file with one story theme per line")
+    parser.add_argument("--out", default="library", help="Output folder (stories.jsonl, images, checkpoint.jsonl)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of stories written at the same time")
+    parser.add_argument("--continuations", type=int, default=3, help="Story parts between the beginning and the ending")
+    parser.add_argument("--model", default=storybot.gpt_model_options[0], choices=storybot.gpt_model_options)
+    parser.add_argument("--dalle-model", default=storybot.dalle_model_options[0], choices=storybot.dalle_model_options)
+    parser.add_argument("--no-images", dest="images", action="store_false", help="Only write the stories, without pictures")
+    parser.add_argument("--hedge", action="store_true", help="Send slow story requests to the fastest model, too, and use whichever answers first (see hedgeRequest() in storybot.py)")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"), help="OpenAI API key (default: OPENAI_API_KEY)")
+    parser.add_argument("--rate-limit", action="append", default=[], metavar="KIND=RPM[/TPM]",
+                        help="Override the rate limits of a kind of request (completion, moderation, image) to match the tier of the API key, e.g. image=50")
+    args = parser.parse_args()
+    if not args.api_key:
+        parser.error("No API key given (set OPENAI_API_KEY or use --api-key)")
+
+    for override in args.rate_limit:
+        kind, _, limits = override.partition("=")
+        requests_per_minute, _, tokens_per_minute = limits.partition("/")
+        if kind not in storybot.rate_limits:
+            parser.error(f"Unknown kind of request: {kind}")
+        storybot.rate_limits[kind] = (int(requests_per_minute), int(tokens_per_minute) if tokens_per_minute else storybot.rate_limits[kind][1])
+
+    with open(args.themes) as f:
+        themes = [line.strip() for line in f if line.strip()]
+    quietStreamlit()
+    summary = runBatch(themes, args.out, args.api_key, args.workers, args.continuations, args.model, args.dalle_model, args.images, args.hedge)
+    print(f"{summary['stories']} stories written ({summary['skipped']} already done, {summary['errors']} failed) in {summary['duration'] / 60:.1f} min, "
+          f"{summary['stories_per_minute']:.2f} stories per minute")
+    sys.exit(1 if summary['errors'] else 0)
+
+if __name__ == "__main__":
+    main()